@@ -1,12 +1,17 @@
+import csv
 import datetime
 import functools
+import io
 import os
+import time
 from telebot_dialogue import Dialogue, DialogueManager
-from tg_bot import bot, cursor, dialogue_manager
+from tg_bot import bot, database, dialogue_manager, scrapper, broadcaster, router
+from router import callback_data
 import sqlite3
 from scrapper import Scrapper
 from settings import settings, logger
-from telebot import types
+from telebot import apihelper, types
+import metrics
 
 
 def is_admin(admins):
@@ -51,13 +56,15 @@ def admin_menu(message):
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     keyboard.add(
         types.InlineKeyboardButton(text='Логи', callback_data='logs'),
+        types.InlineKeyboardButton(text='Метрики', callback_data='metrics_summary'),
         types.InlineKeyboardButton(text='БД', callback_data='db_control'),
         types.InlineKeyboardButton(text='Уведомления', callback_data='notifications_control'),
+        types.InlineKeyboardButton(text='Кэш', callback_data='cache_stats'),
     )
     bot.send_message(message.chat.id, 'Консоль администратора:', reply_markup=keyboard)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'logs')
+@router.route('logs')
 @is_admin(settings.admins)
 def logs_control(call):
     files = [f for f in os.listdir("logs") if f.endswith('.log')]
@@ -77,7 +84,27 @@ def logs_control(call):
     with open(os.path.join("logs", latest_file), encoding='UTF-8') as log_file:
         bot.send_document(call.message.chat.id, log_file)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'db_control')
+@router.route('metrics_summary')
+@is_admin(settings.admins)
+def metrics_summary(call):
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton(text='назад', callback_data='cancel_admin'))
+    bot.send_message(call.message.chat.id, metrics.registry.summary(), reply_markup=keyboard)
+
+@router.route('cache_stats')
+@is_admin(settings.admins)
+def cache_stats(call):
+    stats = scrapper.cache.stats()
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton(text='назад', callback_data='cancel_admin'))
+    bot.send_message(call.message.chat.id,
+                     f"Кэш изменений: {stats['size']}/{stats['capacity']} записей\n"
+                     f"Попадания: {stats['hits']}, промахи: {stats['misses']}, "
+                     f"доля попаданий: {stats['hit_rate']:.1%}",
+                     reply_markup=keyboard)
+
+@router.route('db_control')
+@is_admin(settings.admins)
 def db_control(call):
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(types.InlineKeyboardButton(text='Выйти', callback_data='cancel_admin'))
@@ -86,60 +113,188 @@ def db_control(call):
     dialogue_manager.add_dialogue(dialogue)
 
 
+# Последний результат запроса каждого администратора, разбитый на страницы для кнопок "назад/вперёд"
+query_pages = {}
+
+
+def format_row(row: tuple) -> str:
+    return "|" + "|".join(str(value) for value in row)
+
+
+def paginate(lines: list[str], limit: int = 4000) -> list[str]:
+    pages, page, size = [], [], 0
+    for line in lines:
+        if page and size + len(line) + 1 > limit:
+            pages.append("\n".join(page))
+            page, size = [], 0
+        page.append(line[:limit])
+        size += len(line) + 1
+
+    pages.append("\n".join(page))
+    return pages
+
+
+def page_keyboard(number: int, count: int) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup()
+    buttons = []
+    if number > 0:
+        buttons.append(types.InlineKeyboardButton(text='<', callback_data=callback_data('query_page', number - 1)))
+    if number < count - 1:
+        buttons.append(types.InlineKeyboardButton(text='>', callback_data=callback_data('query_page', number + 1)))
+    if buttons:
+        keyboard.add(*buttons)
+    keyboard.add(types.InlineKeyboardButton(text='Выйти', callback_data='cancel_admin'))
+    return keyboard
+
+
+# Действия, которые sqlite разрешает запросу на чтение; всё остальное запрещается ещё при подготовке запроса
+READ_ACTIONS = {sqlite3.SQLITE_READ, sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+def read_only(action, arg1, arg2, db_name, trigger):
+    # PRAGMA со значением (PRAGMA user_version = 1) меняет базу, без значения только читает
+    if action in READ_ACTIONS or (action == sqlite3.SQLITE_PRAGMA and arg2 is None):
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def run_query(cursor, query: str, deadline: float, row_cap: int) -> tuple[list[str] | None, list[tuple]]:
+    # Прерываем запрос по таймауту, чтобы он не занимал соединение пула и блокировку записи
+    cursor.connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        cursor.execute(query)
+        # description есть у любого запроса, возвращающего строки: SELECT, WITH, PRAGMA, ... RETURNING
+        columns = [column[0] for column in cursor.description] if cursor.description else None
+        rows = []
+        while columns is not None and len(rows) <= row_cap:
+            chunk = cursor.fetchmany(500)
+            if not chunk:
+                break
+            rows.extend(chunk)
+    finally:
+        cursor.connection.set_progress_handler(None, 0)
+
+    return columns, rows
+
+
 def execute_query(message, dialogue):
-    connection = None
+    row_cap = settings["admin_query_row_cap"] or 10000
+    csv_rows = settings["admin_query_csv_rows"] or 200
+    timeout = settings["admin_query_timeout"] or 5
+    deadline = time.monotonic() + timeout
     try:
-        # Устанавливаем соединение с базой данных
-        connection = sqlite3.connect(settings.db)
-        cursor = connection.cursor()
-        query = message.text
+        try:
+            # Чтение идёт без блокировки записи и не мешает скрапперу. Запрос, который что-то меняет,
+            # отклоняется при подготовке, то есть до выполнения, и выполняется один раз уже в write()
+            with database.read() as cursor:
+                cursor.connection.set_authorizer(read_only)
+                try:
+                    columns, rows = run_query(cursor, message.text, deadline, row_cap)
+                finally:
+                    cursor.connection.set_authorizer(None)
+        except sqlite3.DatabaseError as e:
+            if "not authorized" not in str(e):
+                raise
 
-        # Выполняем запрос и получаем результаты
-        cursor.execute(query)
+            # Берём соединение из общего пула, изменения коммитятся при выходе из блока
+            with database.write() as cursor:
+                columns, rows = run_query(cursor, message.text, deadline, row_cap)
 
-        # Определяем, есть ли результат (например, SELECT)
-        if query.strip().lower().startswith("select"):
-            ans = ''
-            result = cursor.fetchall()
-            for res in result:
-                ans += "\n"
-                for row in res:
-                    ans += "|"  + str(row)
+            # Запрос мог поменять Changes в обход скраппера
+            scrapper.cache.clear()
 
-            bot.send_message(dialogue.user_id, ans)
+    except sqlite3.OperationalError as e:
+        if str(e) == "interrupted":
+            bot.send_message(dialogue.user_id, f"Запрос прерван: выполнялся дольше {timeout} с")
         else:
-            # Для запросов, изменяющих данные (INSERT, UPDATE, DELETE)
-            connection.commit()
-        cursor.execute(query)
+            bot.send_message(dialogue.user_id, f"Ошибка при выполнении запроса: {e}")
+        return
 
     except sqlite3.Error as e:
-        connection.rollback()
         bot.send_message(dialogue.user_id, f"Ошибка при выполнении запроса: {e}")
         return
-    finally:
-        if connection:
-            connection.close()
 
-    bot.send_message(message.chat.id, "Запрос выполнен успешно")
+    if columns is None:
+        bot.send_message(message.chat.id, "Запрос выполнен успешно")
+        return
+
+    truncated = len(rows) > row_cap
+    rows = rows[:row_cap]
+    note = f"Показаны первые {row_cap} строк" if truncated else f"Строк: {len(rows)}"
+    if len(rows) > csv_rows:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        document = io.BytesIO(buffer.getvalue().encode("utf-8-sig"))
+        document.name = "query.csv"
+        bot.send_document(message.chat.id, document, caption=note)
+        return
+
+    pages = paginate([format_row(columns)] + [format_row(row) for row in rows])
+    query_pages[message.chat.id] = pages
+    bot.send_message(message.chat.id, pages[0], reply_markup=page_keyboard(0, len(pages)))
+    bot.send_message(message.chat.id, note)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'notifications_control')
+@router.route('query_page')
+@is_admin(settings.admins)
+def query_page(call, number):
+    pages = query_pages.get(call.message.chat.id)
+    number = int(number)
+    if not pages or number >= len(pages):
+        bot.answer_callback_query(call.id, "Результат запроса устарел")
+        return None
+
+    bot.edit_message_text(pages[number], call.message.chat.id, call.message.message_id,
+                          reply_markup=page_keyboard(number, len(pages)))
+    bot.answer_callback_query(call.id)
+
+@router.route('notifications_control')
+@is_admin(settings.admins)
 def notifications_control(call):
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(types.InlineKeyboardButton(text='назад', callback_data='cancel_admin'))
     dialogue = Dialogue(call.message.chat.id, handler=send_notification)
     dialogue_manager.add_dialogue(dialogue)
-    bot.send_message(call.message.chat.id, "отправить уведомление", reply_markup=keyboard)
+    jobs = "\n\n".join(job.progress() for job in broadcaster.recent())
+    bot.send_message(call.message.chat.id, f"{jobs}\n\nотправить уведомление" if jobs else "отправить уведомление",
+                     reply_markup=keyboard)
+
+def broadcast_keyboard(broadcast_id: int, running: bool) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup()
+    if running:
+        keyboard.add(types.InlineKeyboardButton(text='Обновить', callback_data=callback_data('broadcast', 'progress', broadcast_id)),
+                     types.InlineKeyboardButton(text='Отменить', callback_data=callback_data('broadcast', 'cancel', broadcast_id)))
+    keyboard.add(types.InlineKeyboardButton(text='назад', callback_data='cancel_admin'))
+    return keyboard
 
 def send_notification(message, dialogue):
-    cursor.execute("SELECT user_id FROM users")
-    users = cursor.fetchall()
-    for user in users:
-        print(user)
-        bot.send_message(user[0], message.text)
+    # Диалог закрываем до создания рассылки: если закрыть его не получится, рассылка не уйдёт повторно
+    dialogue_manager.finish_dialogue(dialogue.user_id)
+    # Рассылку отправляет диспетчер в фоне, обработчик сразу освобождается
+    broadcast_id = broadcaster.create(message.text)
+    job = broadcaster.get(broadcast_id)
+    bot.send_message(message.chat.id, job.progress(), reply_markup=broadcast_keyboard(broadcast_id, True))
+
+@router.route('broadcast')
+@is_admin(settings.admins)
+def broadcast_control(call, action, broadcast_id):
+    if action == 'cancel':
+        broadcaster.cancel(int(broadcast_id))
 
-    dialogue.finish_dialogue(dialogue.user_id)
+    job = broadcaster.get(int(broadcast_id))
+    if job is None:
+        return None
+
+    try:
+        bot.edit_message_text(job.progress(), call.message.chat.id, call.message.message_id,
+                              reply_markup=broadcast_keyboard(job.id, job.status == 'running'))
+    except apihelper.ApiTelegramException:
+        # Текст не изменился с прошлого обновления
+        pass
+    bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'cancel_admin')
+@router.route('cancel_admin')
 def cancel_admin(call: types.CallbackQuery):
     dialogue_manager.finish_dialogue(call.message.chat.id)
     call.message.from_user.id = call.message.chat.id
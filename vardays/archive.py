@@ -0,0 +1,135 @@
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from database import Database
+from settings import logger
+
+
+class ArchiveEntry:
+    def __init__(self, date: datetime.date, path: str, content_hash: str, file_id: str | None = None):
+        self.date = date
+        self.path = path
+        self.content_hash = content_hash
+        self.file_id = file_id
+
+
+class PdfArchive:
+    def __init__(self, database: Database, directory: str = "pdf_files", version_interval: float = 1) -> None:
+        self.database = database
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.latest_entry = None
+        # Индекс могут поменять другие процессы, перечитываем его, когда меняется счётчик Archive в DataVersions
+        self.version = None
+        # Счётчик сверяем не чаще раза в version_interval секунд, чтобы latest() и get() не ходили в sqlite
+        self.version_interval = version_interval
+        self.version_checked = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.__load()
+
+    def __read_index(self) -> None:
+        with self.database.read() as cursor:
+            version = self.database.data_version("Archive")
+            cursor.execute("""SELECT date, path, hash, file_id FROM Archive""")
+            rows = cursor.fetchall()
+
+        self.entries = {}
+        self.latest_entry = None
+        for date, path, content_hash, file_id in rows:
+            if os.path.exists(path):
+                self.__put(ArchiveEntry(datetime.datetime.strptime(date, "%Y-%m-%d").date(), path, content_hash, file_id))
+        self.version = version
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if now - self.version_checked < self.version_interval:
+            return
+
+        self.version_checked = now
+        if self.database.data_version("Archive") == self.version:
+            return
+
+        with self.lock:
+            self.__read_index()
+
+    def __load(self) -> None:
+        self.__read_index()
+
+        # Файлы, скачанные до появления индекса, добавляем один раз при старте
+        missing = []
+        for file in os.listdir(self.directory):
+            try:
+                date = datetime.datetime.strptime(file.replace('.pdf', ''), '%Y-%m-%d').date()
+            except ValueError:
+                continue
+
+            if date not in self.entries:
+                path = os.path.join(self.directory, file)
+                with open(path, "rb") as pdf_file:
+                    entry = ArchiveEntry(date, path, hashlib.file_digest(pdf_file, "sha256").hexdigest())
+                self.__put(entry)
+                missing.append(entry)
+
+        if missing:
+            with self.database.write() as cursor:
+                cursor.executemany("""INSERT OR REPLACE INTO Archive(date, path, hash) VALUES (?, ?, ?)""",
+                                   [(str(entry.date), entry.path, entry.content_hash) for entry in missing])
+        logger.info(f"Archive index loaded: {len(self.entries)} files, {len(missing)} newly indexed")
+
+    def __written(self, cursor) -> None:
+        # Вызывается внутри транзакции записи: если индекс был актуален, своя запись его не устаревает
+        version = self.database.data_version("Archive")
+        if version - cursor.rowcount == self.version:
+            self.version = version
+
+    def __put(self, entry: ArchiveEntry) -> None:
+        self.entries[entry.date] = entry
+        if self.latest_entry is None or entry.date >= self.latest_entry.date:
+            self.latest_entry = entry
+
+    def get(self, date: datetime.date) -> ArchiveEntry | None:
+        self.refresh()
+        with self.lock:
+            return self.entries.get(date)
+
+    def latest(self) -> ArchiveEntry | None:
+        self.refresh()
+        with self.lock:
+            return self.latest_entry
+
+    def content_hash(self, date: datetime.date) -> str | None:
+        entry = self.get(date)
+        return entry.content_hash if entry else None
+
+    def save(self, date: datetime.date, data: bytes, content_hash: str) -> ArchiveEntry:
+        path = os.path.join(self.directory, f"{date}.pdf")
+        # Пишем во временный файл в той же папке и атомарно подменяем, чтобы читатели не видели недописанный pdf
+        with tempfile.NamedTemporaryFile("wb", dir=self.directory, suffix=".tmp", delete=False) as pdf_file:
+            pdf_file.write(data)
+        os.chmod(pdf_file.name, 0o644)
+        os.replace(pdf_file.name, path)
+
+        # Содержимое поменялось, старый file_id telegram больше не подходит
+        entry = ArchiveEntry(date, path, content_hash)
+        with self.database.write() as cursor:
+            cursor.execute("""INSERT OR REPLACE INTO Archive(date, path, hash, file_id) VALUES (?, ?, ?, NULL)""",
+                           (str(date), path, content_hash))
+            with self.lock:
+                self.__written(cursor)
+                self.__put(entry)
+
+        return entry
+
+    def set_file_id(self, entry: ArchiveEntry, file_id: str | None) -> None:
+        entry.file_id = file_id
+        with self.database.write() as cursor:
+            cursor.execute("""UPDATE Archive SET file_id=? WHERE date=? AND hash=?""",
+                           (file_id, str(entry.date), entry.content_hash))
+            with self.lock:
+                self.__written(cursor)
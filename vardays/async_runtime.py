@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+import aiohttp
+import metrics
+from telebot import TeleBot
+from telebot.async_telebot import AsyncTeleBot
+
+from database import Database
+from dispatcher import Dispatcher
+from scrapper import Scrapper
+from settings import settings, logger
+
+
+class AsyncDatabase:
+    # У sqlite нет асинхронного драйвера, поэтому вся работа с бд (как и синхронные обработчики telebot)
+    # остаётся в потоках: цикл событий только ждёт её через to_thread и не блокируется
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def run(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+
+class AsyncDispatcher(Dispatcher):
+    def __init__(self, bot: AsyncTeleBot, database: Database, **kwargs) -> None:
+        super().__init__(bot, database, **kwargs)
+        self.loop = None
+        self.event = None
+        self.semaphore = None
+
+    def notify(self) -> None:
+        # Вызывается из потоков, поэтому будим цикл событий потокобезопасно
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def start(self) -> None:
+        # Отдельный поток не нужен, диспетчер работает задачей через run_async
+        pass
+
+    async def run_async(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.workers)
+        if self.lease is None:
+            await asyncio.to_thread(self.__requeue)
+        logger.info("Async dispatcher started")
+        while True:
+            if time.monotonic() - self.pruned_at >= self.prune_interval:
+                await asyncio.to_thread(self.maybe_prune)
+            try:
+                sent = await self.drain_async()
+            except Exception as e:
+                logger.error(f"Dispatcher failed to drain outbox: {e}")
+                sent = 0
+
+            if not sent:
+                try:
+                    await asyncio.wait_for(self.event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                self.event.clear()
+
+    def __requeue(self) -> None:
+        with self.database.write() as cursor:
+            self.requeue(cursor)
+
+    async def drain_async(self) -> int:
+        rows = await asyncio.to_thread(self.claim)
+        if not rows:
+            return 0
+
+        results = await asyncio.gather(*(self.__send_async(row) for row in rows))
+        await asyncio.to_thread(self.complete, rows, list(results))
+        return len(rows)
+
+    async def __send_async(self, row) -> tuple[str, float]:
+        _, user_id, text, attempts, _ = row
+        async with self.semaphore:
+            await self.chat_bucket(user_id).acquire_async()
+            await self.bucket.acquire_async()
+            try:
+                with metrics.send_seconds.time():
+                    await self.bot.send_message(user_id, text)
+                return "delivered", 0
+
+            except Exception as e:
+                return self.handle_error(e, user_id, attempts)
+
+
+class BridgeBot(AsyncTeleBot):
+    # Обновления принимаются асинхронно, а обрабатываются уже зарегистрированными хендлерами синхронного бота
+    def __init__(self, token: str, sync_bot: TeleBot) -> None:
+        super().__init__(token)
+        self.sync_bot = sync_bot
+
+    async def process_new_updates(self, updates) -> None:
+        if updates:
+            await asyncio.to_thread(self.sync_bot.process_new_updates, updates)
+
+
+class AsyncRuntime:
+    # Асинхронными здесь стали только сеть и ожидание: скачивание pdf, отправка из очереди и опрос telegram.
+    # Обработчики сообщений остаются синхронными и идут в пул потоков telebot, запросы к бд и разбор pdf — в to_thread
+    def __init__(self, bot: TeleBot, scrapper: Scrapper, tg_handler, groups: list[str], period: int = 10,
+                 scrape: bool = True, poll: bool = True) -> None:
+        self.bot = bot
+        self.scrapper = scrapper
+        self.tg_handler = tg_handler
+        self.groups = groups
+        self.period = period
+        self.scrape = scrape
+        # Опрашивать telegram может только один процесс на токен, иначе 409 Conflict
+        self.poll = poll
+        self.lease = tg_handler.lease
+        self.database = AsyncDatabase(scrapper.database)
+        self.async_bot = BridgeBot(bot.token, bot)
+        self.dispatcher = AsyncDispatcher(self.async_bot, scrapper.database,
+                                          workers=settings["dispatcher_workers"] or 8,
+                                          rate=settings["send_rate"] or 30,
+                                          lease=self.lease,
+                                          retention_days=settings["outbox_retention_days"] or 7)
+        tg_handler.dispatcher = self.dispatcher
+        tg_handler.broadcaster.dispatcher = self.dispatcher
+        self.session = None
+
+    async def fetch(self):
+        logger.debug("Retrieving variable day schedule")
+        with metrics.fetch_seconds.time():
+            async with self.session.get(self.scrapper.url, headers=self.scrapper.request_headers(),
+                                        cookies=self.scrapper.cookies) as response:
+                self.scrapper.status_code = response.status
+                if response.status == 304:
+                    logger.debug("PDF not modified since last fetch")
+                    return None
+
+                if response.status != 200:
+                    logger.error(f"Failed to download PDF. Status code: {response.status}")
+                    return False
+
+                data = await response.read()
+                headers = response.headers
+
+        # Разбор pdf нагружает процессор, уносим его из цикла событий
+        return await asyncio.to_thread(self.scrapper.parse_varday, data, headers)
+
+    async def run_cycle(self):
+        document = await self.fetch()
+        result = await self.database.run(self.scrapper.update_document, document, self.groups)
+        await self.database.run(self.tg_handler.notify_subscribers)
+        if isinstance(result, dict):
+            await self.database.run(self.tg_handler.notify_keywords, self.scrapper.document)
+        return result
+
+    async def scrape_loop(self) -> None:
+        scheduler = await asyncio.to_thread(self.tg_handler.make_scheduler, self.period)
+        if self.lease is not None:
+            self.lease.start()
+        # Рассылка только ставит сообщения в очередь, ей хватает отдельного потока
+        self.tg_handler.broadcaster.start()
+        while True:
+            if self.lease is not None and not self.lease.is_leader():
+                await asyncio.sleep(self.lease.ttl / 3)
+                continue
+
+            if scheduler.breaker.allow():
+                try:
+                    result = await self.run_cycle()
+                    scheduler.record_fetch(self.scrapper.status_code in (200, 304), isinstance(result, dict))
+                except Exception as e:
+                    logger.error(f"Scrape cycle failed: {e}")
+                    scheduler.record_fetch(False, False)
+
+            await asyncio.sleep(scheduler.next_delay())
+
+    async def main(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            self.session = session
+            logger.info("Async runtime started")
+            tasks = []
+            if self.poll:
+                tasks.append(self.async_bot.infinity_polling())
+            if self.scrape:
+                tasks += [self.scrape_loop(), self.dispatcher.run_async()]
+            await asyncio.gather(*tasks)
+
+    def run(self) -> None:
+        asyncio.run(self.main())
@@ -0,0 +1,123 @@
+import argparse
+import datetime
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PyPDF2 import PdfReader
+
+from database import Database
+from extractor import _extract_pages
+from scrapper import extract_changes
+from settings import settings, logger
+
+
+def _parse_file(path: str, groups: list[str]) -> tuple[str, str | None, str | None, dict[str, list[str]] | None]:
+    # Выполняется в дочернем процессе: тот же разбор, что и в Scrapper, только для файла из архива
+    try:
+        with open(path, "rb") as pdf_file:
+            data = pdf_file.read()
+
+        date = datetime.datetime.strptime(os.path.basename(path).replace('.pdf', ''), '%Y-%m-%d').date()
+        text = "".join(_extract_pages(data, list(range(len(PdfReader(io.BytesIO(data)).pages)))))
+        return path, hashlib.sha256(data).hexdigest(), str(date), extract_changes(text, groups)
+    except Exception as e:
+        # Один битый файл не должен останавливать pool.map и весь перезапуск
+        logger.error(f"Backfill: failed to parse {path}: {e}")
+        return path, None, None, None
+
+
+def archive_files(directory: str) -> list[str]:
+    files = []
+    for file in sorted(os.listdir(directory)):
+        try:
+            datetime.datetime.strptime(file.replace('.pdf', ''), '%Y-%m-%d')
+        except ValueError:
+            continue
+        files.append(os.path.join(directory, file))
+
+    return files
+
+
+def backfill(database: Database,
+             groups: list[str],
+             directory: str = "pdf_files",
+             workers: int = None,
+             batch_size: int = 50,
+             restart: bool = False,
+             ) -> int:
+    if restart:
+        with database.write() as cursor:
+            cursor.execute("""DELETE FROM Backfill""")
+
+    with database.read() as cursor:
+        cursor.execute("""SELECT path, hash FROM Backfill""")
+        done = dict(cursor.fetchall())
+
+    # Файлы, разобранные прошлым запуском и не поменявшиеся с тех пор, пропускаем
+    files = []
+    for path in archive_files(directory):
+        if path in done:
+            with open(path, "rb") as pdf_file:
+                if hashlib.file_digest(pdf_file, "sha256").hexdigest() == done[path]:
+                    continue
+        files.append(path)
+
+    logger.info(f"Backfill: {len(files)} files to process, {len(done)} already done")
+    processed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_parse_file, files, [groups] * len(files), chunksize=4)
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= batch_size:
+                processed += _write_batch(database, groups, batch)
+                batch = []
+
+        if batch:
+            processed += _write_batch(database, groups, batch)
+
+    if processed < len(files):
+        logger.warning(f"Backfill: {len(files) - processed} files failed to parse and were skipped")
+    return processed
+
+
+def _write_batch(database: Database, groups: list[str], batch: list[tuple]) -> int:
+    upserts, deletes, checkpoints = [], [], []
+    for path, content_hash, date, changes in batch:
+        # Неразобранный файл не отмечаем в Backfill, следующий запуск попробует его снова
+        if changes is None:
+            continue
+        for group in groups:
+            if group in changes:
+                upserts.append((date, "\n".join(changes[group]), group))
+            else:
+                deletes.append((date, group))
+        checkpoints.append((path, content_hash))
+
+    # Изменения и отметка о прогрессе пишутся одной транзакцией, поэтому после падения можно продолжить
+    with database.write() as cursor:
+        cursor.executemany("""INSERT INTO Changes(date, changes, group_for) VALUES (?, ?, ?)
+                              ON CONFLICT(group_for, date) DO UPDATE SET changes=excluded.changes
+                              WHERE changes != excluded.changes""", upserts)
+        cursor.executemany("""DELETE FROM Changes WHERE date=? AND group_for=?""", deletes)
+        cursor.executemany("""INSERT OR REPLACE INTO Backfill(path, hash, processed) VALUES (?, ?, CURRENT_TIMESTAMP)""",
+                           checkpoints)
+
+    logger.info(f"Backfill: wrote {len(upserts)} changes from {len(checkpoints)} files")
+    return len(checkpoints)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Перезаполняет таблицу Changes из архива pdf_files")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--restart", action="store_true", help="разобрать заново все файлы, игнорируя прогресс")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    count = backfill(Database(settings["db"]), settings["groups"], workers=args.workers, batch_size=args.batch,
+                     restart=args.restart)
+    print(f"Обработано файлов: {count} за {time.monotonic() - started:.1f} с.")
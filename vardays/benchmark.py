@@ -0,0 +1,300 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Модули проекта читают settings.json из текущей папки при импорте, поэтому импортируем их
+# только после того, как подготовим временную папку с синтетическими настройками (см. main)
+
+UPPER = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+LOWER = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+# Кириллица через стандартный шрифт Helvetica: перекодируем буквы в байты 128+ и задаём им имена глифов Adobe
+GLYPHS = {char: f"afii{10017 + index}" for index, char in enumerate(UPPER)}
+GLYPHS.update({char: f"afii{10065 + index}" for index, char in enumerate(LOWER)})
+CODES = {char: 128 + index for index, char in enumerate(UPPER + LOWER)}
+WORDS = ["урок", "замена", "каб.", "физика", "история", "перенос", "Иванова", "Петров", "нет", "литература"]
+
+
+def _encode_line(line: str) -> bytes:
+    encoded = bytearray()
+    for char in line:
+        if char in CODES:
+            encoded.append(CODES[char])
+        elif char in "()\\":
+            encoded += b"\\" + char.encode()
+        else:
+            encoded += char.encode("latin-1", "replace")
+
+    return bytes(encoded)
+
+
+def make_pdf(pages: list[list[str]]) -> bytes:
+    differences = " ".join(f"{CODES[char]} /{GLYPHS[char]}" for char in UPPER + LOWER)
+    objects = [f"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding << /Type /Encoding "
+               f"/BaseEncoding /WinAnsiEncoding /Differences [{differences}] >> >>".encode()]
+    page_ids = []
+    for lines in pages:
+        stream = b"BT /F1 10 Tf 40 800 Td 12 TL\n"
+        stream += b"".join(b"(" + _encode_line(line) + b") Tj T*\n" for line in lines) + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(None)
+        page_ids.append((len(objects), len(objects) - 1))
+
+    pages_id = len(objects) + 1
+    for page_id, contents_id in page_ids:
+        objects[page_id - 1] = (f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 595 842] "
+                                f"/Resources << /Font << /F1 1 0 R >> >> /Contents {contents_id} 0 R >>").encode()
+    kids = " ".join(f"{page_id} 0 R" for page_id, _ in page_ids)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode())
+    objects.append(f"<< /Type /Catalog /Pages {pages_id} 0 R >>".encode())
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    return bytes(pdf)
+
+
+def make_groups(count: int) -> list[str]:
+    return [f"{number}{letter}" for letter in "абвгде" for number in range(1, 12)][:count]
+
+
+def make_varday(groups: list[str], date: str, pages: int, lines_per_group: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    lines = [f"{group} - {' '.join(rng.choices(WORDS, k=6))} {rng.randint(1, 8)}"
+             for group in groups for _ in range(lines_per_group)]
+    per_page = max(1, -(-len(lines) // pages))
+    chunks = [lines[i:i + per_page] for i in range(0, len(lines), per_page)] or [[]]
+    chunks[0].insert(0, f"Изменения в расписании на {date}")
+    return make_pdf(chunks)
+
+
+class VardayServer:
+    # Отдаёт pdf из памяти и поддерживает ETag, как сервер школы
+    def __init__(self) -> None:
+        self.data = b""
+        self.etag = ""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get("If-None-Match") == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/pdf")
+                self.send_header("Content-Length", str(len(server.data)))
+                self.send_header("ETag", server.etag)
+                self.end_headers()
+                self.wfile.write(server.data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/varday.pdf"
+
+    def publish(self, data: bytes) -> None:
+        self.data = data
+        self.etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+
+
+class FakeBotApi:
+    # Минимальный Bot API: на любой метод отвечает успехом, sendMessage возвращает сообщение
+    def __init__(self) -> None:
+        self.requests = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят двумя записями: с Nagle на keep-alive соединении каждый ответ ждал
+            # отложенный ACK (~40 мс), и замеры диспетчера показывали задержку заглушки, а не свою
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                params = {key: value[0] for key, value in parse_qs(urlparse(self.path).query).items()}
+                params.update({key: value[0] for key, value in parse_qs(body).items()})
+                with server.lock:
+                    server.requests += 1
+                    message_id = server.requests
+
+                result = {"message_id": message_id, "date": int(time.time()),
+                          "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                          "text": params.get("text", "")}
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/bot{{0}}/{{1}}"
+
+
+class Report:
+    def __init__(self) -> None:
+        self.rows = []
+
+    def add(self, stage: str, items: int, samples: list[float]) -> None:
+        total = sum(samples)
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        self.rows.append((stage, items, total, items / total if total else float("inf"),
+                          statistics.median(ordered) * 1000, p95 * 1000))
+
+    def print(self) -> None:
+        print(f"{'stage':<34}{'items':>10}{'total, s':>12}{'items/s':>14}{'p50, ms':>12}{'p95, ms':>12}")
+        for stage, items, total, throughput, p50, p95 in self.rows:
+            print(f"{stage:<34}{items:>10}{total:>12.3f}{throughput:>14.1f}{p50:>12.3f}{p95:>12.3f}")
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def run(args, report: Report) -> None:
+    import telebot
+
+    import tg_bot
+    from dispatcher import Dispatcher
+    from extractor import TextExtractor
+    from scrapper import Scrapper, extract_changes
+    from tg_handler import TgHandler
+
+    groups = make_groups(args.classes)
+    varday_server = VardayServer()
+    bot_api = FakeBotApi()
+    telebot.apihelper.API_URL = bot_api.url
+
+    database = tg_bot.database
+    scrapper = Scrapper(url=varday_server.url, db=database, archive=tg_bot.archive,
+                        extractor=TextExtractor(workers=args.workers))
+
+    # Скачивание и разбор: каждый раз новое содержимое, чтобы не срабатывали ETag, хэш и кэш страниц
+    date = "20.10"
+    samples = []
+    for index in range(args.repeat):
+        varday_server.publish(make_varday(groups, date, args.pages, args.lines, seed=index))
+        elapsed, document = timed(scrapper.fetch_varday)
+        samples.append(elapsed)
+    report.add(f"fetch+parse ({args.pages} pages)", args.repeat, samples)
+
+    elapsed, unchanged = timed(scrapper.fetch_varday)
+    report.add("fetch, 304 not modified", 1, [elapsed])
+
+    text, document_date = document
+    samples = [timed(extract_changes, text, groups)[0] for _ in range(args.repeat)]
+    report.add(f"extraction ({len(groups)} classes)", len(groups) * args.repeat, samples)
+    changes = extract_changes(text, groups)
+
+    samples = []
+    for index in range(args.repeat):
+        # Меняем текст, чтобы upsert действительно обновлял строки
+        elapsed, _ = timed(lambda: [scrapper.update_group(group, [*changes.get(group, []), str(index)], document_date)
+                                    for group in groups])
+        samples.append(elapsed)
+    report.add("db upsert (per class)", len(groups) * args.repeat, samples)
+
+    for subscribers in args.subscribers:
+        users = max(1, subscribers // args.subs_per_user)
+        with database.write() as cursor:
+            cursor.execute("""DELETE FROM Subs""")
+            cursor.execute("""DELETE FROM Outbox""")
+            cursor.executemany("""INSERT OR IGNORE INTO Subs(user_id, subgroup, last_update, last_change)
+                                  VALUES (?, ?, '2000-01-01', 'None')""",
+                               [(user, groups[(user + shift) % len(groups)])
+                                for user in range(1, users + 1) for shift in range(args.subs_per_user)])
+            scanned = cursor.execute("""SELECT COUNT(*) FROM Subs""").fetchone()[0]
+
+        dispatcher = Dispatcher(tg_bot.bot, database, workers=args.send_workers, rate=10 ** 9, chat_rate=10 ** 9,
+                                batch_size=500)
+        handler = TgHandler(tg_bot.bot, "bench.db", scrapper, dispatcher)
+
+        elapsed, pending = timed(tg_bot.get_pending_notifications)
+        report.add(f"fan-out query ({scanned} subs)", scanned, [elapsed])
+        elapsed, _ = timed(handler.send_messages, pending)
+        report.add(f"fan-out enqueue ({len(pending)} notif.)", len(pending), [elapsed])
+
+        latencies = []
+        send_message = tg_bot.bot.send_message
+
+        def timed_send(*send_args, **send_kwargs):
+            started = time.perf_counter()
+            try:
+                return send_message(*send_args, **send_kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+        tg_bot.bot.send_message = timed_send
+        limit = args.dispatch_limit or None
+        started = time.perf_counter()
+        sent = 0
+        while limit is None or sent < limit:
+            drained = dispatcher.drain()
+            if not drained:
+                break
+            sent += drained
+        total = time.perf_counter() - started
+        tg_bot.bot.send_message = send_message
+        report.add(f"dispatch ({sent} messages)", sent, [total])
+        if latencies:
+            report.add("send latency (per message)", len(latencies), latencies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Оффлайн-бенчмарк цикла скраппер → подписчики → отправка")
+    parser.add_argument("--classes", type=int, default=40)
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--lines", type=int, default=3, help="строк изменений на класс")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None, help="процессы для разбора страниц")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--subs-per-user", type=int, default=2)
+    parser.add_argument("--send-workers", type=int, default=16)
+    parser.add_argument("--dispatch-limit", type=int, default=0, help="максимум отправок на шаг, 0 - без ограничения")
+    args = parser.parse_args()
+
+    project = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="varday_bench_")
+    with open(os.path.join(workdir, "settings.json"), "w", encoding="utf-8") as file:
+        json.dump({"token": "0:benchmark", "db": "bench.db", "groups": make_groups(args.classes),
+                   "log_level": "WARNING", "admins": []}, file, ensure_ascii=False)
+    os.chdir(workdir)
+    sys.path.insert(0, project)
+    print(f"Рабочая папка бенчмарка: {workdir}")
+
+    report = Report()
+    run(args, report)
+    report.print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import threading
+
+from database import Database
+from dispatcher import Dispatcher
+from lease import Lease
+from settings import logger
+
+
+class BroadcastJob:
+    def __init__(self, id: int, text: str, status: str, total: int, queued: int, sent: int, failed: int,
+                 blocked: int, created: str, finished: str | None):
+        self.id = id
+        self.text = text
+        self.status = status
+        self.total = total
+        self.queued = queued
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.created = created
+        self.finished = finished
+
+    def progress(self) -> str:
+        done = self.sent + self.failed + self.blocked
+        percent = done * 100 // self.total if self.total else 100
+        statuses = {"running": "идёт", "done": "завершена", "cancelled": "отменена"}
+        return (f"Рассылка #{self.id} ({statuses.get(self.status, self.status)}): {percent}%\n"
+                f"Получателей: {self.total}, в очереди: {self.queued - done}\n"
+                f"Доставлено: {self.sent}, ошибок: {self.failed}, заблокировали бота: {self.blocked}")
+
+
+class Broadcaster:
+    def __init__(self, database: Database, dispatcher: Dispatcher, page_size: int = 500,
+                 lease: Lease = None) -> None:
+        self.database = database
+        self.dispatcher = dispatcher
+        # Сколько сообщений одной рассылки держим в очереди диспетчера, следующая страница ставится по мере отправки
+        self.page_size = page_size
+        self.lease = lease
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def create(self, text: str) -> int:
+        # Создать рассылку может любой процесс, отправляет её тот, у кого работает диспетчер
+        with self.database.write() as cursor:
+            cursor.execute("""INSERT INTO Broadcasts(text, total) VALUES (?, (SELECT COUNT(DISTINCT user_id) FROM Users))""",
+                           (text,))
+            broadcast_id = cursor.lastrowid
+        logger.info(f"Broadcast {broadcast_id} created")
+        self.wakeup.set()
+        return broadcast_id
+
+    def get(self, broadcast_id: int) -> BroadcastJob | None:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT id, text, status, total, queued, sent, failed, blocked, created, finished
+                              FROM Broadcasts WHERE id=?""", (broadcast_id,))
+            row = cursor.fetchone()
+
+        return BroadcastJob(*row) if row else None
+
+    def recent(self, limit: int = 5) -> list[BroadcastJob]:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT id, text, status, total, queued, sent, failed, blocked, created, finished
+                              FROM Broadcasts ORDER BY id DESC LIMIT ?""", (limit,))
+            return [BroadcastJob(*row) for row in cursor.fetchall()]
+
+    def cancel(self, broadcast_id: int) -> None:
+        with self.database.write() as cursor:
+            cursor.execute("""UPDATE Broadcasts SET status='cancelled', finished=CURRENT_TIMESTAMP
+                              WHERE id=? AND status='running'""", (broadcast_id,))
+            # Уже отправляемые сообщения долетят, остальные из очереди убираем
+            cursor.execute("""DELETE FROM Outbox WHERE broadcast_id=? AND status='pending'""", (broadcast_id,))
+            cursor.execute("""UPDATE Broadcasts SET queued=queued-? WHERE id=?""", (cursor.rowcount, broadcast_id))
+
+    def step(self) -> int:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT id, text, last_user_id FROM Broadcasts WHERE status='running' ORDER BY id""")
+            jobs = cursor.fetchall()
+
+        queued = 0
+        for broadcast_id, text, last_user_id in jobs:
+            queued += self.__fill(broadcast_id, text, last_user_id)
+
+        return queued
+
+    def __fill(self, broadcast_id: int, text: str, last_user_id: int) -> int:
+        with self.database.write() as cursor:
+            if self.lease is not None and not self.lease.fence(cursor):
+                return 0
+
+            cursor.execute("""SELECT COUNT(*) FROM Outbox WHERE broadcast_id=? AND status IN ('pending', 'sending')""",
+                           (broadcast_id,))
+            in_flight = cursor.fetchone()[0]
+            if in_flight >= self.page_size:
+                return 0
+
+            # Keyset-пагинация: следующая страница начинается после последнего поставленного в очередь user_id
+            cursor.execute("""SELECT DISTINCT user_id FROM Users WHERE user_id > ? ORDER BY user_id LIMIT ?""",
+                           (last_user_id, self.page_size - in_flight))
+            users = [row[0] for row in cursor.fetchall()]
+            if not users:
+                if not in_flight:
+                    cursor.execute("""UPDATE Broadcasts SET status='done', finished=CURRENT_TIMESTAMP WHERE id=?""",
+                                   (broadcast_id,))
+                    logger.info(f"Broadcast {broadcast_id} finished")
+                return 0
+
+            # Очередь и курсор пишутся одной транзакцией, после перезапуска рассылка продолжится с того же места
+            self.dispatcher.enqueue(cursor, [(user_id, text) for user_id in users], broadcast_id)
+            cursor.execute("""UPDATE Broadcasts SET last_user_id=?, queued=queued+? WHERE id=?""",
+                           (users[-1], len(users), broadcast_id))
+
+        self.dispatcher.notify()
+        return len(users)
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Broadcaster failed: {e}")
+
+            self.wakeup.wait(timeout=1)
+            self.wakeup.clear()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name="broadcaster")
+        self.thread.start()
+        logger.info("Broadcaster started")
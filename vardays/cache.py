@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, size: int = 2048, ttl: float | None = None) -> None:
+        self.size = size
+        # Время жизни записи в секундах, None — пока не вытеснят или не сбросят
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                value, expires = self.data[key]
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, *keys) -> None:
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,276 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from settings import logger
+
+
+def _create_tables(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Changes(
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        date TEXT NOT NULL,
+        changes TEXT NOT NULL,
+        group_for TEXT NOT NULL)""")
+
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Subs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        user_id INTEGER NOT NULL,
+        subgroup TEXT NOT NULL,
+        last_update TEXT NOT NULL,
+        last_change TEXT NOT NULL)""")
+
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Users(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL)""")
+
+    # Старый Scrapper создавал Subs без last_change
+    columns = [column[1] for column in cursor.execute("""PRAGMA table_info(Subs)""")]
+    if "last_change" not in columns:
+        cursor.execute("""ALTER TABLE Subs ADD COLUMN last_change TEXT NOT NULL DEFAULT 'None'""")
+
+
+def _index_changes(cursor: sqlite3.Cursor) -> None:
+    # Оставляем только последнюю запись для каждой пары класс-дата, иначе уникальный индекс не создать
+    cursor.execute(
+        """DELETE FROM Changes WHERE id NOT IN (SELECT MAX(id) FROM Changes GROUP BY group_for, date)""")
+    cursor.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_changes_group_date ON Changes(group_for, date)""")
+    # Покрывающий индекс для get_varday и get_last_varday, чтобы не ходить в саму таблицу
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_changes_group_date_changes ON Changes(group_for, date DESC, changes)""")
+
+
+def _index_subs(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """DELETE FROM Subs WHERE id NOT IN (SELECT MAX(id) FROM Subs GROUP BY user_id, subgroup)""")
+    cursor.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_subs_user_subgroup ON Subs(user_id, subgroup)""")
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_subs_subgroup ON Subs(subgroup)""")
+
+
+def _create_outbox(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Outbox(
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        user_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)""")
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_outbox_status ON Outbox(status, next_attempt)""")
+
+
+def _create_archive(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Archive(
+        date TEXT PRIMARY KEY NOT NULL,
+        path TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        file_id TEXT)""")
+
+
+def _create_backfill(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Backfill(
+        path TEXT PRIMARY KEY NOT NULL,
+        hash TEXT NOT NULL,
+        processed TEXT NOT NULL)""")
+
+
+def _create_leases(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Leases(
+        name TEXT PRIMARY KEY NOT NULL,
+        owner TEXT NOT NULL,
+        token INTEGER NOT NULL,
+        expires REAL NOT NULL)""")
+
+
+def _create_broadcasts(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Broadcasts(
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        queued INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished TEXT)""")
+    cursor.execute("""ALTER TABLE Outbox ADD COLUMN broadcast_id INTEGER""")
+    cursor.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_broadcast ON Outbox(broadcast_id, status)""")
+    # Получатели рассылки читаются страницами по user_id
+    cursor.execute("""CREATE INDEX IF NOT EXISTS idx_users_user_id ON Users(user_id)""")
+
+
+def _create_dialogues(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Dialogues(
+        user_id INTEGER PRIMARY KEY NOT NULL,
+        handler TEXT NOT NULL,
+        context TEXT NOT NULL,
+        state INTEGER NOT NULL,
+        expires REAL NOT NULL)""")
+    cursor.execute("""CREATE INDEX IF NOT EXISTS idx_dialogues_expires ON Dialogues(expires)""")
+
+
+def _create_keyword_subs(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS KeywordSubs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        user_id INTEGER NOT NULL,
+        keyword TEXT NOT NULL,
+        last_date TEXT,
+        last_match TEXT,
+        UNIQUE(user_id, keyword))""")
+    cursor.execute("""CREATE INDEX IF NOT EXISTS idx_keyword_subs_keyword ON KeywordSubs(keyword)""")
+
+
+def _create_data_versions(cursor: sqlite3.Cursor) -> None:
+    # Счётчики изменений таблиц: процессы бота сверяют их перед чтением своих кэшей и видят запись другого процесса
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS DataVersions(
+        name TEXT PRIMARY KEY NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0)""")
+    for table in ("Changes", "Archive"):
+        cursor.execute("""INSERT OR IGNORE INTO DataVersions(name) VALUES (?)""", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_{event.lower()}_version AFTER {event} ON {table}
+                BEGIN UPDATE DataVersions SET version=version+1 WHERE name='{table}'; END""")
+
+
+# Номер миграции хранится в PRAGMA user_version, новые миграции добавляются только в конец
+MIGRATIONS = [
+    _create_tables,
+    _index_changes,
+    _index_subs,
+    _create_outbox,
+    _create_archive,
+    _create_backfill,
+    _create_leases,
+    _create_broadcasts,
+    _create_dialogues,
+    _create_keyword_subs,
+    _create_data_versions,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    cursor = conn.cursor()
+    cursor.execute("""BEGIN IMMEDIATE""")
+    try:
+        version = cursor.execute("""PRAGMA user_version""").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying database migration {number}: {migration.__name__}")
+            migration(cursor)
+            cursor.execute(f"""PRAGMA user_version = {number}""")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def connect(db: str) -> sqlite3.Connection:
+    # cached_statements: пул держит соединения открытыми, поэтому подготовленные запросы переиспользуются
+    conn = sqlite3.connect(db, check_same_thread=False, timeout=30, cached_statements=256)
+    # WAL позволяет читателям бота не блокировать запись скраппера
+    conn.execute("""PRAGMA journal_mode=WAL""")
+    return conn
+
+
+class Database:
+    def __init__(self, db: str, size: int = 8) -> None:
+        self.db = db
+        self.size = size
+        self.pool = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        # SQLite допускает одного писателя, сериализуем запись внутри процесса, чтобы не ловить "database is locked"
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+
+        conn = connect(db)
+        migrate(conn)
+        self.created += 1
+        self.pool.put(conn)
+
+    def __acquire(self) -> sqlite3.Connection:
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return connect(self.db)
+
+        return self.pool.get()
+
+    @contextmanager
+    def connection(self):
+        # Поток повторно получает своё же соединение, поэтому вложенные read/write видят одну транзакцию
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self.__acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.pool.put(conn)
+
+    @contextmanager
+    def read(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def write(self):
+        with self.write_lock, self.connection() as conn:
+            cursor = conn.cursor()
+            if getattr(self.local, "writing", False):
+                # Вложенная запись коммитится вместе с внешней
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+                return
+
+            self.local.writing = True
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.local.writing = False
+                cursor.close()
+
+    def data_version(self, table: str) -> int:
+        with self.read() as cursor:
+            cursor.execute("""SELECT version FROM DataVersions WHERE name=?""", (table,))
+            return cursor.fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            while not self.pool.empty():
+                self.pool.get_nowait().close()
+                self.created -= 1
@@ -0,0 +1,165 @@
+import datetime
+import importlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from telebot_dialogue import Dialogue, DialogueManager
+
+from database import Database
+from settings import logger
+
+
+def _encode(value):
+    # В контексте диалогов лежат даты, json их сам не умеет
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Can't store {type(value).__name__} in dialogue context")
+
+
+def _decode(obj: dict):
+    if "__datetime__" in obj:
+        return datetime.datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return datetime.date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def _handler_name(handler) -> str:
+    return f"{handler.__module__}:{handler.__qualname__}"
+
+
+def _resolve_handler(name: str):
+    module, qualname = name.split(":", 1)
+    handler = importlib.import_module(module)
+    for attribute in qualname.split("."):
+        handler = getattr(handler, attribute)
+    return handler
+
+
+class DialogueUpdater(DialogueManager.DialogueUpdater):
+    def __init__(self, store: "DialogueStore", dialogue: Dialogue | None) -> None:
+        super().__init__(dialogue)
+        self.store = store
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        # Изменения, сделанные внутри with, сохраняются в хранилище
+        if exc_type is None and self.dialogue is not None:
+            self.store.save(self.dialogue)
+
+
+class DialogueStore(DialogueManager):
+    def __init__(self, ttl: float = 3600, max_size: int = 10000, database: Database = None) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.max_size = max_size
+        # Без бд диалоги живут в памяти процесса, с бд их видят все процессы бота и они переживают перезапуск
+        self.database = database
+        # user_id -> (диалог, время истечения), порядок — от давно использованных к недавним
+        self.dialogues = OrderedDict()
+        self.lock = threading.Lock()
+        self.saves = 0
+
+    def add_dialogue(self, dialogue: Dialogue, force: bool = False) -> bool:
+        if self.find_dialogue(dialogue.user_id) and not force:
+            return False
+
+        self.save(dialogue)
+        return True
+
+    def save(self, dialogue: Dialogue) -> None:
+        expires = time.time() + self.ttl
+        if self.database is not None:
+            with self.database.write() as cursor:
+                cursor.execute("""INSERT OR REPLACE INTO Dialogues(user_id, handler, context, state, expires)
+                                  VALUES (?, ?, ?, ?, ?)""",
+                               (dialogue.user_id, _handler_name(dialogue.handler),
+                                json.dumps(dialogue.context, default=_encode), dialogue.state, expires))
+        else:
+            with self.lock:
+                self.dialogues[dialogue.user_id] = (dialogue, expires)
+                self.dialogues.move_to_end(dialogue.user_id)
+                while len(self.dialogues) > self.max_size:
+                    self.dialogues.popitem(last=False)
+
+        self.saves += 1
+        if self.saves % 1000 == 0:
+            self.cleanup()
+
+    def find_dialogue(self, user_id: int) -> Dialogue | None:
+        if self.database is not None:
+            return self.__load(user_id)
+
+        with self.lock:
+            item = self.dialogues.get(user_id)
+            if item is None:
+                return None
+
+            dialogue, expires = item
+            if expires <= time.time():
+                del self.dialogues[user_id]
+                return None
+
+            self.dialogues.move_to_end(user_id)
+            return dialogue
+
+    def __load(self, user_id: int) -> Dialogue | None:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT handler, context, state FROM Dialogues WHERE user_id=? AND expires > ?""",
+                           (user_id, time.time()))
+            row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        handler, context, state = row
+        try:
+            dialogue = Dialogue(user_id, handler=_resolve_handler(handler),
+                                context=json.loads(context, object_hook=_decode))
+        except (ImportError, AttributeError, ValueError) as e:
+            # Обработчик переименовали между версиями бота, такой диалог продолжить нельзя
+            logger.warning(f"Dropping stored dialogue of {user_id}: {e}")
+            self.finish_dialogue(user_id)
+            return None
+
+        dialogue.state = bool(state)
+        return dialogue
+
+    def finish_dialogue(self, user_id: int) -> bool:
+        if self.database is not None:
+            with self.database.write() as cursor:
+                cursor.execute("""DELETE FROM Dialogues WHERE user_id=?""", (user_id,))
+                return cursor.rowcount > 0
+
+        with self.lock:
+            return self.dialogues.pop(user_id, None) is not None
+
+    def handle_message(self, message) -> bool:
+        dialogue = self.find_dialogue(message.from_user.id)
+        if dialogue is None or not dialogue.state:
+            return False
+
+        dialogue.init_handler(message)
+        # История сообщений нигде не используется, а держит в памяти все объекты Message
+        dialogue.clear_history()
+        return True
+
+    def update(self, user_id: int) -> DialogueUpdater:
+        return DialogueUpdater(self, self.find_dialogue(user_id))
+
+    def cleanup(self) -> int:
+        now = time.time()
+        if self.database is not None:
+            with self.database.write() as cursor:
+                cursor.execute("""DELETE FROM Dialogues WHERE expires <= ?""", (now,))
+                return cursor.rowcount
+
+        with self.lock:
+            expired = [user_id for user_id, (_, expires) in self.dialogues.items() if expires <= now]
+            for user_id in expired:
+                del self.dialogues[user_id]
+        return len(expired)
+
@@ -0,0 +1,262 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import TeleBot
+
+from database import Database
+from lease import Lease
+import metrics
+from settings import logger
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def __refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        # Возвращает 0, если токен взят, иначе сколько секунд подождать
+        with self.lock:
+            now = time.monotonic()
+            self.__refill(now)
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self) -> None:
+        while wait := self.try_acquire():
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        while wait := self.try_acquire():
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        # Telegram ответил 429: не отправляем ничего, пока не истечёт retry_after
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def is_full(self) -> bool:
+        with self.lock:
+            self.__refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+class Dispatcher:
+    def __init__(self,
+                 bot: TeleBot,
+                 database: Database,
+                 workers: int = 8,
+                 rate: float = 30,
+                 chat_rate: float = 1,
+                 batch_size: int = 100,
+                 max_attempts: int = 5,
+                 lease: Lease = None,
+                 retention_days: float = 7,
+                 prune_interval: float = 3600,
+                 ) -> None:
+        self.bot = bot
+        self.database = database
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.epoch = None
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.pruned_at = 0
+        self.chat_rate = chat_rate
+        self.bucket = TokenBucket(rate)
+        self.chat_buckets = {}
+        self.chat_lock = threading.Lock()
+        self.pool = None
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def enqueue(cursor, messages: list[tuple[int, str]], broadcast_id: int = None) -> None:
+        # Вызывается внутри транзакции вызывающего, чтобы уведомления и состояние подписок записались вместе
+        cursor.executemany("""INSERT INTO Outbox(user_id, text, broadcast_id) VALUES (?, ?, ?)""",
+                           [(user_id, text, broadcast_id) for user_id, text in messages])
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        if self.lease is None:
+            with self.database.write() as cursor:
+                self.requeue(cursor)
+        self.thread = threading.Thread(target=self.run, daemon=True, name="dispatcher")
+        self.thread.start()
+        logger.info("Dispatcher started")
+
+    @staticmethod
+    def requeue(cursor) -> None:
+        # Сообщения, которые отправлялись во время прошлого падения, отправим ещё раз
+        cursor.execute("""UPDATE Outbox SET status='pending' WHERE status='sending'""")
+
+    def prune(self, batch_size: int = 5000) -> int:
+        # Отправленные и окончательно неудачные сообщения больше не нужны, иначе Outbox растёт без конца.
+        # Удаляем порциями, чтобы не держать блокировку записи долго
+        self.pruned_at = time.monotonic()
+        deleted = 0
+        while True:
+            with self.database.write() as cursor:
+                cursor.execute("""DELETE FROM Outbox WHERE id IN (
+                                      SELECT id FROM Outbox WHERE status IN ('delivered', 'failed', 'blocked')
+                                      AND created < datetime('now', ?) LIMIT ?)""",
+                               (f"-{self.retention_days} days", batch_size))
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+
+        if deleted:
+            logger.info(f"Pruned {deleted} finished outbox messages")
+        return deleted
+
+    def maybe_prune(self) -> None:
+        if time.monotonic() - self.pruned_at < self.prune_interval:
+            return
+
+        try:
+            self.prune()
+        except Exception as e:
+            logger.error(f"Failed to prune outbox: {e}")
+
+    def run(self) -> None:
+        while True:
+            self.maybe_prune()
+            try:
+                sent = self.drain()
+            except Exception as e:
+                logger.error(f"Dispatcher failed to drain outbox: {e}")
+                sent = 0
+
+            if not sent:
+                self.wakeup.wait(timeout=1)
+                self.wakeup.clear()
+
+    def drain(self) -> int:
+        rows = self.claim()
+        if not rows:
+            return 0
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dispatcher")
+
+        self.complete(rows, list(self.pool.map(self.__send, rows)))
+        return len(rows)
+
+    def claim(self) -> list[tuple]:
+        with self.database.write() as cursor:
+            if self.lease is not None:
+                # Очередь разбирает только лидер; новый лидер забирает то, что не успел отправить прежний
+                if not self.lease.fence(cursor):
+                    return []
+                if self.epoch != self.lease.token:
+                    self.requeue(cursor)
+                    self.epoch = self.lease.token
+
+            cursor.execute("""SELECT id, user_id, text, attempts, broadcast_id FROM Outbox
+                              WHERE status='pending' AND next_attempt <= ?
+                              ORDER BY id LIMIT ?""",
+                           (time.time(), self.batch_size))
+            rows = cursor.fetchall()
+            cursor.executemany("""UPDATE Outbox SET status='sending' WHERE id=?""", [(row[0],) for row in rows])
+
+        return rows
+
+    def complete(self, rows: list[tuple], results: list[tuple[str, float]]) -> None:
+        retry = []
+        outcomes = {"delivered": [], "failed": [], "blocked": []}
+        # Итоги по рассылкам: broadcast_id -> число сообщений в каждом исходе
+        broadcasts = {}
+        for row, (status, delay) in zip(rows, results):
+            if status == "retry":
+                if row[3] + 1 < self.max_attempts:
+                    retry.append((time.time() + delay, row[0]))
+                    continue
+                status = "failed"
+
+            outcomes[status].append((row[0],))
+            if row[4] is not None:
+                broadcasts.setdefault(row[4], dict.fromkeys(outcomes, 0))[status] += 1
+
+        delivered, failed, blocked = outcomes["delivered"], outcomes["failed"], outcomes["blocked"]
+        with self.database.write() as cursor:
+            cursor.executemany("""UPDATE Outbox SET status='delivered', attempts=attempts+1 WHERE id=?""", delivered)
+            cursor.executemany("""UPDATE Outbox SET status='pending', attempts=attempts+1, next_attempt=? WHERE id=?""",
+                               retry)
+            cursor.executemany("""UPDATE Outbox SET status='failed', attempts=attempts+1 WHERE id=?""", failed)
+            cursor.executemany("""UPDATE Outbox SET status='blocked', attempts=attempts+1 WHERE id=?""", blocked)
+            cursor.executemany("""UPDATE Broadcasts SET sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?""",
+                               [(counts["delivered"], counts["failed"], counts["blocked"], broadcast_id)
+                                for broadcast_id, counts in broadcasts.items()])
+
+        metrics.messages_sent.inc(len(delivered))
+        metrics.messages_failed.inc(len(failed) + len(blocked))
+
+        logger.debug(f"Outbox batch: {len(delivered)} delivered, {len(retry)} retried, {len(failed)} failed, "
+                     f"{len(blocked)} blocked")
+
+    def chat_bucket(self, user_id: int) -> TokenBucket:
+        with self.chat_lock:
+            bucket = self.chat_buckets.get(user_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 10000:
+                    # Полные корзины ничем не отличаются от новых, их можно выбросить
+                    self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full()}
+                bucket = self.chat_buckets[user_id] = TokenBucket(self.chat_rate)
+
+            return bucket
+
+    def __send(self, row) -> tuple[str, float]:
+        _, user_id, text, attempts, _ = row
+        self.chat_bucket(user_id).acquire()
+        self.bucket.acquire()
+        try:
+            with metrics.send_seconds.time():
+                self.bot.send_message(user_id, text)
+            return "delivered", 0
+
+        except Exception as e:
+            return self.handle_error(e, user_id, attempts)
+
+    def handle_error(self, e: Exception, user_id: int, attempts: int) -> tuple[str, float]:
+        # У синхронного и асинхронного telebot разные классы ApiTelegramException, смотрим только на error_code
+        error_code = getattr(e, "error_code", None)
+        if error_code == 429:
+            retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+            logger.warning(f"Telegram rate limit hit, retrying after {retry_after}s")
+            metrics.rate_limited.inc()
+            self.bucket.pause(retry_after)
+            return "retry", retry_after
+
+        if error_code == 403:
+            # Пользователь заблокировал бота, повторять бессмысленно
+            logger.info(f"Message to {user_id} rejected: {e.description}")
+            return "blocked", 0
+
+        if error_code == 400:
+            # Чат не существует или сообщение некорректно
+            logger.info(f"Message to {user_id} rejected: {e.description}")
+            return "failed", 0
+
+        logger.error(f"Failed to send message to {user_id}: {e}")
+        return "retry", 2 ** attempts
@@ -0,0 +1,126 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PyPDF2 import PdfReader
+from settings import logger
+
+
+def _extract_pages(data: bytes, indexes: list[int]) -> list[str]:
+    # Выполняется в дочернем процессе: объекты страниц не сериализуются, поэтому передаём байты pdf
+    reader = PdfReader(io.BytesIO(data))
+    return [reader.pages[index].extract_text() for index in indexes]
+
+
+def _hash_fonts(resources, hasher, depth: int = 0) -> None:
+    # Текст страницы зависит не только от потока команд, но и от кодировок шрифтов (Encoding, ToUnicode):
+    # при переэкспорте pdf поток часто совпадает байт в байт, а подмножество шрифта — нет
+    if resources is None or depth > 3:
+        return
+
+    resources = resources.get_object()
+    fonts = resources.get("/Font")
+    if fonts is not None:
+        fonts = fonts.get_object()
+        for name in sorted(fonts):
+            font = fonts[name].get_object()
+            hasher.update(str(name).encode())
+            for key in ("/Subtype", "/BaseFont", "/Encoding", "/FirstChar", "/Widths"):
+                value = font.get(key)
+                if value is not None:
+                    value = value.get_object()
+                    hasher.update(f"{key}={value}".encode())
+            to_unicode = font.get("/ToUnicode")
+            if to_unicode is not None:
+                hasher.update(to_unicode.get_object().get_data())
+            descendants = font.get("/DescendantFonts")
+            # Массив может лежать косвенной ссылкой (/DescendantFonts 6 0 R)
+            for descendant in descendants.get_object() if descendants is not None else []:
+                hasher.update(str(descendant.get_object().get("/CIDSystemInfo")).encode())
+
+    # Формы (XObject) несут свои ресурсы со своими шрифтами
+    xobjects = resources.get("/XObject")
+    if xobjects is not None:
+        xobjects = xobjects.get_object()
+        for name in sorted(xobjects):
+            xobject = xobjects[name].get_object()
+            if xobject.get("/Subtype") == "/Form":
+                hasher.update(str(name).encode())
+                hasher.update(xobject.get_data())
+                _hash_fonts(xobject.get("/Resources"), hasher, depth + 1)
+
+
+class TextExtractor:
+    def __init__(self,
+                 workers: int = None,
+                 min_parallel_pages: int = 4,
+                 cache_size: int = 512,
+                 ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel_pages = min_parallel_pages
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def extract(self, reader: PdfReader, data: bytes, indexes: list[int] = None) -> list[str]:
+        if indexes is None:
+            indexes = list(range(len(reader.pages)))
+
+        keys = {index: self.page_key(reader.pages[index]) for index in indexes}
+        texts = {}
+        missing = []
+        with self.lock:
+            for index, key in keys.items():
+                if key is not None and key in self.cache:
+                    self.cache.move_to_end(key)
+                    texts[index] = self.cache[key]
+                else:
+                    missing.append(index)
+
+        logger.debug(f"Extracting {len(missing)} of {len(indexes)} pages, others taken from cache")
+        for index, text in zip(missing, self.__extract_missing(reader, data, missing)):
+            texts[index] = text
+
+        with self.lock:
+            for index in missing:
+                if keys[index] is not None:
+                    self.cache[keys[index]] = texts[index]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return [texts[index] for index in indexes]
+
+    @staticmethod
+    def page_key(page) -> str | None:
+        try:
+            contents = page.get_contents()
+            hasher = hashlib.sha256(contents.get_data() if contents is not None else b"")
+            _hash_fonts(page.get("/Resources"), hasher)
+        except Exception as e:
+            # Непонятный словарь шрифта не должен ронять разбор: такую страницу просто извлекаем без кэша
+            logger.warning(f"Can't build page cache key, extracting without cache: {e}")
+            return None
+        return hasher.hexdigest()
+
+    def __extract_missing(self, reader: PdfReader, data: bytes, indexes: list[int]) -> list[str]:
+        if len(indexes) < self.min_parallel_pages:
+            return [reader.pages[index].extract_text() for index in indexes]
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        chunks = [indexes[i::self.workers] for i in range(self.workers) if indexes[i::self.workers]]
+        results = {}
+        for chunk, texts in zip(chunks, self.pool.map(_extract_pages, [data] * len(chunks), chunks)):
+            results.update(zip(chunk, texts))
+
+        return [results[index] for index in indexes]
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,122 @@
+import re
+import threading
+
+from database import Database
+from settings import logger
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower().replace("ё", "е"))
+
+
+def normalize(keyword: str) -> str:
+    return " ".join(tokenize(keyword))
+
+
+class KeywordIndex:
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        # Обратный индекс: первое слово ключа -> {ключ -> id пользователей}.
+        # Поиск идёт по словам документа, поэтому не зависит от числа подписчиков
+        self.index = {}
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.count = 0
+        self.rebuild()
+
+    def __add(self, user_id: int, keyword: str) -> None:
+        self.index.setdefault(keyword.split(" ", 1)[0], {}).setdefault(keyword, set()).add(user_id)
+
+    def __remove(self, user_id: int, keyword: str) -> None:
+        first = keyword.split(" ", 1)[0]
+        users = self.index.get(first, {}).get(keyword)
+        if users is None:
+            return
+
+        users.discard(user_id)
+        if not users:
+            del self.index[first][keyword]
+            if not self.index[first]:
+                del self.index[first]
+
+    def rebuild(self) -> None:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT id, user_id, keyword FROM KeywordSubs""")
+            rows = cursor.fetchall()
+
+        with self.lock:
+            self.index = {}
+            for _, user_id, keyword in rows:
+                self.__add(user_id, keyword)
+            self.last_id = max((row[0] for row in rows), default=0)
+            self.count = len(rows)
+        logger.info(f"Keyword index built: {len(rows)} subscriptions")
+
+    def refresh(self) -> None:
+        # Подписки могли поменяться в другом процессе бота: новые строки доливаем, а после удалений строим заново
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT COALESCE(MAX(id), 0), COUNT(*) FROM KeywordSubs""")
+            last_id, count = cursor.fetchone()
+            if last_id == self.last_id and count == self.count:
+                return
+
+            cursor.execute("""SELECT id, user_id, keyword FROM KeywordSubs WHERE id > ?""", (self.last_id,))
+            rows = cursor.fetchall()
+
+        if self.count + len(rows) != count:
+            self.rebuild()
+            return
+
+        with self.lock:
+            for _, user_id, keyword in rows:
+                self.__add(user_id, keyword)
+            self.last_id = last_id
+            self.count = count
+
+    def subscribe(self, user_id: int, keyword: str) -> bool:
+        keyword = normalize(keyword)
+        with self.database.write() as cursor:
+            cursor.execute("""INSERT OR IGNORE INTO KeywordSubs(user_id, keyword) VALUES (?, ?)""", (user_id, keyword))
+            if not cursor.rowcount:
+                return False
+
+        self.refresh()
+        return True
+
+    def unsubscribe(self, user_id: int, subscription_id: int) -> str | None:
+        with self.database.write() as cursor:
+            cursor.execute("""SELECT keyword FROM KeywordSubs WHERE id=? AND user_id=?""", (subscription_id, user_id))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute("""DELETE FROM KeywordSubs WHERE id=?""", (subscription_id,))
+
+        with self.lock:
+            self.__remove(user_id, row[0])
+            self.count -= 1
+        return row[0]
+
+    def subscriptions(self, user_id: int) -> list[tuple[int, str]]:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT id, keyword FROM KeywordSubs WHERE user_id=? ORDER BY id""", (user_id,))
+            return cursor.fetchall()
+
+    def match(self, text: str) -> dict[tuple[int, str], list[str]]:
+        self.refresh()
+        # (user_id, ключ) -> строки документа, где встретился ключ
+        hits = {}
+        with self.lock:
+            for line in text.splitlines():
+                tokens = tokenize(line)
+                for position, token in enumerate(tokens):
+                    for keyword, users in self.index.get(token, {}).items():
+                        if " " in keyword and " ".join(tokens[position:position + keyword.count(" ") + 1]) != keyword:
+                            continue
+                        for user_id in users:
+                            lines = hits.setdefault((user_id, keyword), [])
+                            if not lines or lines[-1] != line.strip():
+                                lines.append(line.strip())
+
+        return hits
@@ -0,0 +1,81 @@
+import os
+import socket
+import threading
+import time
+
+from database import Database
+from settings import logger
+
+
+class Lease:
+    def __init__(self, database: Database, name: str = "scraper", ttl: float = 30, owner: str = None) -> None:
+        self.database = database
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        # Номер поколения лидера (fencing token), растёт при каждой смене владельца
+        self.token = None
+        self.expires = 0
+        self.thread = None
+
+    def acquire(self) -> bool:
+        now = time.time()
+        with self.database.write() as cursor:
+            # Одним запросом: продлеваем свою аренду или забираем истёкшую чужую
+            cursor.execute("""INSERT INTO Leases(name, owner, token, expires) VALUES (?, ?, 1, ?)
+                              ON CONFLICT(name) DO UPDATE SET
+                              token=CASE WHEN owner=excluded.owner THEN token ELSE token + 1 END,
+                              owner=excluded.owner, expires=excluded.expires
+                              WHERE owner=excluded.owner OR expires <= ?""",
+                           (self.name, self.owner, now + self.ttl, now))
+            cursor.execute("""SELECT token FROM Leases WHERE name=? AND owner=?""", (self.name, self.owner))
+            row = cursor.fetchone()
+
+        token = row[0] if row else None
+        if token != self.token:
+            if token is None:
+                logger.warning(f"Lost {self.name} leadership (token {self.token})")
+            else:
+                logger.info(f"Became {self.name} leader with token {token}")
+        self.token = token
+        self.expires = now + self.ttl if token is not None else 0
+        return token is not None
+
+    def is_leader(self) -> bool:
+        return self.token is not None and time.time() < self.expires
+
+    def fence(self, cursor) -> bool:
+        # Вызывается первым в транзакции записи: берёт блокировку бд и проверяет, что лидер всё ещё мы.
+        # Процесс, который завис дольше ttl, после этого ничего не запишет, даже если сам ещё не заметил потерю
+        if self.token is None:
+            return False
+
+        cursor.execute("""UPDATE Leases SET expires=expires WHERE name=? AND owner=? AND token=? AND expires > ?""",
+                       (self.name, self.owner, self.token, time.time()))
+        return cursor.rowcount == 1
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.acquire()
+            except Exception as e:
+                logger.error(f"Failed to renew {self.name} lease: {e}")
+                self.token = None
+
+            time.sleep(self.ttl / 3)
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"lease-{self.name}")
+        self.thread.start()
+
+    def release(self) -> None:
+        if self.token is None:
+            return
+
+        with self.database.write() as cursor:
+            cursor.execute("""UPDATE Leases SET expires=0 WHERE name=? AND owner=? AND token=?""",
+                           (self.name, self.owner, self.token))
+        self.token = None
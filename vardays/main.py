@@ -6,29 +6,51 @@ from scrapper import *
 if __name__ == '__main__':
     from tg_handler import *
 
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Changes(
-        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, 
-        date TEXT NOT NULL, 
-        changes TEXT NOT NULL, 
-        group_for TEXT NOT NULL)""")
-
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Subs(
-        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, 
-        user_id INTEGER NOT NULL, 
-        subgroup TEXT NOT NULL, 
-        last_update TEXT NOT NULL, 
-        last_change TEXT NOT NULL)""")
-
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Users(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL)""")
-
-    conn.commit()
-
-    # Запускаем скраппер в отдельном потоке
-    tg_handler = TgHandler(bot=bot, scrapper=scrapper, db=db)
-    scraper_thread = threading.Thread(target=tg_handler.start_cycle, daemon=True, args=(10,))
-    scraper_thread.start()
-    logger.info("Бот запущен!")
-    bot.infinity_polling()
+    # role: "bot" только принимает обновления, "scraper" только скрапит и рассылает, "all" делает всё.
+    # Если роль задана явно, скраппер работает под арендой в бд, и из нескольких процессов активен один.
+    # Long polling telegram разрешает только одному процессу, поэтому несколько процессов с ролью "bot"
+    # запускаются только с runtime "webhook"
+    role = settings["role"] or "all"
+    if role == "bot" and settings["runtime"] != "webhook":
+        logger.warning('Role "bot" uses long polling: run only one such process or switch to runtime "webhook"')
+    lease = None
+    if settings["role"] in ("scraper", "all"):
+        from lease import Lease
+
+        lease = Lease(database, ttl=settings["lease_ttl"] or 30)
+
+    tg_handler = TgHandler(bot=bot, scrapper=scrapper, db=db, lease=lease)
+    if settings["metrics_port"]:
+        import metrics
+
+        metrics.registry.serve(settings["metrics_port"])
+
+    # Один и тот же период во всех режимах, чтобы min_period планировщика не зависел от runtime
+    cycle_period = settings["cycle_period"] or 10
+    if settings["runtime"] == "async":
+        # Скраппер, диспетчер и приём обновлений работают задачами в одном цикле событий
+        from async_runtime import AsyncRuntime
+
+        logger.info(f"Бот запущен в асинхронном режиме, роль {role}!")
+        AsyncRuntime(bot, scrapper, tg_handler, GROUPS, cycle_period, scrape=role != "bot",
+                     poll=role != "scraper").run()
+    elif role == "scraper":
+        logger.info("Скраппер запущен без приёма обновлений!")
+        tg_handler.start_cycle(cycle_period)
+    else:
+        if role != "bot":
+            # Запускаем скраппер в отдельном потоке
+            scraper_thread = threading.Thread(target=tg_handler.start_cycle, daemon=True, args=(cycle_period,))
+            scraper_thread.start()
+        if settings["runtime"] == "webhook":
+            # Обновления приходят по http, несколько процессов могут стоять за одним балансировщиком
+            import webhook
+
+            server = webhook.from_settings(bot)
+            if settings["webhook_url"]:
+                server.register(settings["webhook_url"])
+            logger.info(f"Бот запущен в режиме вебхука, роль {role}!")
+            server.serve_forever()
+        else:
+            logger.info(f"Бот запущен, роль {role}!")
+            bot.infinity_polling()
@@ -0,0 +1,147 @@
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import settings, logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    def __init__(self, registry, name: str, description: str) -> None:
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    def __init__(self, registry, name: str, description: str, buckets=DEFAULT_BUCKETS) -> None:
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        if not self.registry.enabled:
+            return nullcontext()
+        return _Timer(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            total = 0
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Registry:
+    def __init__(self, enabled: bool = False) -> None:
+        # Выключенный реестр не берёт блокировок и не засекает время, вызовы почти бесплатны
+        self.enabled = enabled
+        self.metrics = {}
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(self, name, description))
+
+    def histogram(self, name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(self, name, description, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        if not self.enabled:
+            return "Метрики выключены (настройка metrics)"
+
+        lines = []
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                average = metric.sum / metric.count * 1000 if metric.count else 0
+                lines.append(f"{metric.description}: {metric.count} раз, среднее {average:.1f} мс")
+            else:
+                lines.append(f"{metric.description}: {metric.value:g}")
+        return "\n".join(lines)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                payload = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+        return server
+
+
+registry = Registry(enabled=bool(settings["metrics"] or settings["metrics_port"]))
+
+fetch_seconds = registry.histogram("varday_fetch_seconds", "Скачивание pdf")
+parse_seconds = registry.histogram("varday_parse_seconds", "Разбор pdf")
+extract_seconds = registry.histogram("varday_extract_seconds", "Поиск изменений по классам")
+db_write_seconds = registry.histogram("varday_db_write_seconds", "Запись изменений в бд")
+subscribers_scanned = registry.counter("varday_subscribers_scanned_total", "Подписок с новыми изменениями")
+messages_queued = registry.counter("varday_messages_queued_total", "Сообщений поставлено в очередь")
+messages_sent = registry.counter("varday_messages_sent_total", "Сообщений отправлено")
+messages_failed = registry.counter("varday_messages_failed_total", "Сообщений не доставлено")
+rate_limited = registry.counter("varday_telegram_429_total", "Ответов 429 от telegram")
+send_seconds = registry.histogram("varday_send_seconds", "Отправка сообщения")
@@ -0,0 +1,42 @@
+from telebot import TeleBot, types
+
+SEPARATOR = ":"
+# Ограничение telegram на длину callback_data
+MAX_CALLBACK_DATA = 64
+
+
+def callback_data(*parts) -> str:
+    # Всё состояние шага (действие, дата, класс) кодируется в самой кнопке, на сервере ничего хранить не нужно
+    data = SEPARATOR.join(str(part) for part in parts)
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data is longer than {MAX_CALLBACK_DATA} bytes: {data}")
+    return data
+
+
+class CallbackRouter:
+    def __init__(self) -> None:
+        # Префикс callback_data -> обработчик, поиск за O(1) вместо перебора лямбд telebot
+        self.routes = {}
+
+    def route(self, *prefixes: str):
+        def decorator(func):
+            for prefix in prefixes:
+                self.routes[prefix] = func
+            return func
+
+        return decorator
+
+    def matches(self, call: types.CallbackQuery) -> bool:
+        return call.data.partition(SEPARATOR)[0] in self.routes
+
+    def dispatch(self, call: types.CallbackQuery) -> None:
+        prefix, _, args = call.data.partition(SEPARATOR)
+        handler = self.routes[prefix]
+        if args:
+            handler(call, *args.split(SEPARATOR))
+        else:
+            handler(call)
+
+    def register(self, bot: TeleBot) -> None:
+        # Регистрируется раньше остальных обработчиков, поэтому telebot проверяет его первым
+        bot.register_callback_query_handler(self.dispatch, func=self.matches)
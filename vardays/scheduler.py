@@ -0,0 +1,105 @@
+import datetime
+import os
+import random
+import time
+from collections import Counter
+
+from settings import logger
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, reset_timeout: float = 600) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        # После reset_timeout пропускаем одну пробную попытку (half-open)
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def remaining(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record(self, success: bool) -> None:
+        if success:
+            if self.opened_at is not None:
+                logger.info("Circuit breaker closed, school server is available again")
+            self.failures = 0
+            self.opened_at = None
+            return
+
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker opened after {self.failures} failed fetches")
+            self.opened_at = time.monotonic()
+
+
+class AdaptiveScheduler:
+    def __init__(self,
+                 min_period: float = 10,
+                 max_period: float = 1800,
+                 window_minutes: int = 45,
+                 slot_minutes: int = 15,
+                 jitter: float = 0.2,
+                 breaker: CircuitBreaker = None,
+                 ) -> None:
+        self.min_period = min_period
+        self.max_period = max_period
+        self.window_minutes = window_minutes
+        self.slot_minutes = slot_minutes
+        self.jitter = jitter
+        self.breaker = breaker or CircuitBreaker()
+        # Сколько раз файл менялся в каждый слот недели: (день недели, номер слота в сутках)
+        self.history = Counter()
+        self.backoff = min_period
+
+    def __slot(self, moment: datetime.datetime) -> tuple[int, int]:
+        return moment.weekday(), (moment.hour * 60 + moment.minute) // self.slot_minutes
+
+    def record_change(self, moment: datetime.datetime = None) -> None:
+        self.history[self.__slot(moment or datetime.datetime.now())] += 1
+
+    def learn_from_archive(self, directory: str = "pdf_files") -> None:
+        # Время изменения архивных pdf совпадает с моментом, когда скраппер увидел новую версию
+        if not os.path.exists(directory):
+            return
+
+        for file in os.listdir(directory):
+            if file.endswith(".pdf"):
+                self.record_change(datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(directory, file))))
+        logger.info(f"Scheduler learned {sum(self.history.values())} upload times from {directory}")
+
+    def in_window(self, moment: datetime.datetime = None) -> bool:
+        if not self.history:
+            # Истории ещё нет, опрашиваем как раньше
+            return True
+
+        moment = moment or datetime.datetime.now()
+        slots = self.window_minutes // self.slot_minutes
+        weekday, slot = self.__slot(moment)
+        slots_per_day = 24 * 60 // self.slot_minutes
+        for offset in range(-slots, slots + 1):
+            day, index = divmod(weekday * slots_per_day + slot + offset, slots_per_day)
+            if self.history[(day % 7, index)]:
+                return True
+
+        return False
+
+    def record_fetch(self, success: bool, changed: bool) -> None:
+        self.breaker.record(success)
+        if changed:
+            self.record_change()
+
+    def next_delay(self) -> float:
+        if self.in_window():
+            self.backoff = self.min_period
+        else:
+            # Вне окон загрузки отступаем экспоненциально
+            self.backoff = min(self.max_period, self.backoff * 2)
+
+        delay = max(self.backoff, self.breaker.remaining())
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -1,109 +1,247 @@
 import datetime
-import os
+import functools
+import hashlib
+import io
 import re
+import time
 import requests
-import sqlite3
 from PyPDF2 import PdfReader
 import logging
-import shutil
 from settings import logger
+from extractor import TextExtractor
+from database import Database
+from archive import PdfArchive
+from cache import LRUCache, MISSING
+import metrics
 
 from asyncpg.pgproto.pgproto import timedelta
 
 
+@functools.lru_cache(maxsize=8)
+def _changes_pattern(groups: tuple[str, ...]) -> re.Pattern:
+    # Длинные названия первыми, чтобы "10б" не съедался более коротким совпадением
+    names = sorted(groups, key=len, reverse=True)
+    return re.compile(rf"(?<!\w)({'|'.join(map(re.escape, names))})\s*-\s*([^\n]+)")
+
+
+def extract_changes(text: str, groups) -> dict[str, list[str]]:
+    # Один проход по тексту для всех классов сразу, сохраняем все строки класса, а не только первую
+    logger.debug(f"Searching for changes for {len(groups)} groups")
+    names = {group.lower(): group for group in groups}
+    changes = {}
+    for match in _changes_pattern(tuple(names)).finditer(text.lower()):
+        changes.setdefault(names[match.group(1)], []).append(match.group(2))
+
+    logger.debug(f"Changes found for groups: {', '.join(changes)}")
+    return changes
+
+
 class Scrapper:
     def __init__(self,
                  url: str = "https://liceum1.vsevobr.ru/temp/varday.pdf",
                  headers: dict = None,
                  cookies: dict = None,
-                 db: str = "data.db",
+                 db: str | Database = "data.db",
+                 extractor: TextExtractor = None,
+                 archive: PdfArchive = None,
+                 cache_ttl: float | None = 300,
+                 version_interval: float = 1,
                  ) -> None:
         self.url = url
         self.headers = headers or {}
         self.cookies = cookies or {}
         self.session = requests.Session()
-        self.conn = sqlite3.connect(db, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS Changes(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, date TEXT NOT NULL, changes TEXT NOT NULL, group_for TEXT NOT NULL)""")
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS Subs(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL, subgroup TEXT NOT NULL, last_update TEXT NOT NULL)""")
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS Users(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL)""")
-        self.conn.commit()
-        if not os.path.exists("pdf_files"):
-            os.makedirs("pdf_files")
+        # Валидаторы последнего скачанного файла, чтобы не качать и не разбирать его повторно
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.document = None
+        self.status_code = None
+        self.extractor = extractor or TextExtractor()
+        self.database = db if isinstance(db, Database) else Database(db)
+        self.archive = archive or PdfArchive(self.database, version_interval=version_interval)
+        # Ответы get_varday/get_last_varday, сбрасываются при записи изменений класса.
+        # Изменения может записать и другой процесс (роль scraper, backfill), это видно по счётчику в DataVersions
+        self.cache = LRUCache(ttl=cache_ttl)
+        self.changes_version = None
+        # Счётчик сверяем не чаще раза в version_interval секунд, чтобы попадания в кэш не ходили в sqlite
+        self.version_interval = version_interval
+        self.version_checked = 0
         logger.debug("Scrapper initialized")
 
-    def update_varday(self, group) -> tuple[str, datetime.date] | bool | None:
-        logger.debug(f"Retrieving variable day schedule for group: {group}")
-        response = self.session.get(self.url, cookies=self.cookies, headers=self.headers, stream=True)
-        if response.status_code != 200:
-            logger.error(f"Failed to download PDF. Status code: {response.status_code}")
+    def request_headers(self) -> dict:
+        headers = dict(self.headers)
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
+
+    def fetch_varday(self) -> tuple[str, datetime.date] | bool | None:
+        logger.debug("Retrieving variable day schedule")
+        with metrics.fetch_seconds.time():
+            response = self.session.get(self.url, cookies=self.cookies, headers=self.request_headers(), stream=True)
+            self.status_code = response.status_code
+            if response.status_code == 304:
+                logger.debug("PDF not modified since last fetch")
+                return None
+
+            if response.status_code != 200:
+                logger.error(f"Failed to download PDF. Status code: {response.status_code}")
+                return False
+
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=8192):
+                buffer.write(chunk)
+            logger.debug(f"PDF downloaded, {buffer.tell()} bytes")
+
+        return self.parse_varday(buffer.getvalue(), response.headers)
+
+    def parse_varday(self, data: bytes, headers) -> tuple[str, datetime.date] | bool | None:
+        with metrics.parse_seconds.time():
+            return self.__parse_varday(data, headers)
+
+    def __remember(self, headers, content_hash: str) -> None:
+        # Валидаторы запоминаем только после успешного разбора, иначе битая загрузка застрянет за 304
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.content_hash = content_hash
+
+    def __parse_varday(self, data: bytes, headers) -> tuple[str, datetime.date] | bool | None:
+        content_hash = hashlib.sha256(data).hexdigest()
+        if content_hash == self.content_hash:
+            logger.debug("PDF content is unchanged, skipping parsing")
+            return None
+
+        buffer = io.BytesIO(data)
+        reader = PdfReader(buffer)
+
+        if not reader.pages:
+            logger.warning("PDF has no pages")
             return False
-    
-        temp_pdf_path = os.path.join("pdf_files", "temp.pdf")
-        content = response.iter_content(chunk_size=8192)
-        with open(temp_pdf_path, "wb") as pdf_file:
-            for chunk in content:
-                pdf_file.write(chunk)
-        logger.debug(f"PDF downloaded and saved to {temp_pdf_path}")
-    
-        reader = PdfReader(temp_pdf_path)
-    
-        parsed_text = []
-        for page in reader.pages:
-            parsed_text.append(page.extract_text())
 
-        text = "".join(parsed_text)
-        date = self.__get_date_from_text(text)
+        # Дата стоит в заголовке, поэтому сначала разбираем только первую страницу
+        first_page = self.extractor.extract(reader, data, [0])[0]
+        date = self.__get_date_from_text(first_page)
 
-        previos_changes = self.get_last_varday(group)
+        previos_changes = self.get_last_date()
         if not previos_changes:
-            previos_changes = (None, datetime.date.max-datetime.timedelta(days=180))
+            previos_changes = datetime.date.max-datetime.timedelta(days=180)
 
-        if not date or not date <= previos_changes[1]+timedelta(days=180):
+        if not date or not date <= previos_changes+timedelta(days=180):
             logger.warning("No date found in the PDF or year incorrect")
             return False
-    
-        path = os.path.join("pdf_files", f"{date}.pdf")
 
-        shutil.move(temp_pdf_path, path)
-        logger.debug(f"PDF renamed to {path}")
-    
-        changes = self.__get_changes_for_group(text, group)
-        
+        if self.archive.content_hash(date) == content_hash:
+            logger.debug(f"PDF for {date} is already archived, skipping parsing")
+            self.__remember(headers, content_hash)
+            return None
+
+        parsed_text = self.extractor.extract(reader, data, list(range(1, len(reader.pages))))
+        text = "".join([first_page, *parsed_text])
+
+        entry = self.archive.save(date, data, content_hash)
+        logger.debug(f"PDF saved to {entry.path}")
+        self.__remember(headers, content_hash)
+
+        self.document = text, date
+        return self.document
+
+    def update_group(self, group, changes: list[str] | None, date: datetime.date) -> tuple[str, datetime.date] | bool | None:
         if not changes:
             logger.debug(f"No changes found for group {group}")
             return None
-    
-        self.cursor.execute('''SELECT * FROM Changes WHERE group_for=? AND date=? LIMIT 1''',
-                            (group, date.strftime("%Y-%m-%d")))
-        alr_changes = self.cursor.fetchone()
-        if alr_changes and alr_changes[2] == changes:
+
+        changes = "\n".join(changes)
+        with metrics.db_write_seconds.time(), self.database.write() as cursor:
+            cursor.execute('''INSERT INTO Changes(date, changes, group_for) VALUES (?, ?, ?)
+                              ON CONFLICT(group_for, date) DO UPDATE SET changes=excluded.changes
+                              WHERE changes != excluded.changes''',
+                           (date.strftime("%Y-%m-%d"), changes, group))
+            updated = cursor.rowcount
+            # Счётчик в той же транзакции: триггер прибавил по единице на каждую изменённую строку
+            version = self.database.data_version("Changes") if updated else None
+
+        if not updated:
             logger.debug(f"Changes for group {group} are up-to-date")
             return True
 
-        if alr_changes and alr_changes[2] != changes or not alr_changes:
-            self.cursor.execute('''INSERT OR REPLACE INTO Changes(date, changes, group_for) VALUES (?, ?, ?)''',
-                                (date.strftime("%Y-%m-%d"), str(changes), group))
-            self.conn.commit()
-            logger.debug(f"Changes for group {group} updated in the database")
-    
+        # Если до нашей записи кэш был актуален, своя запись не сбрасывает его целиком, хватает точечной инвалидации
+        if version - updated == self.changes_version:
+            self.changes_version = version
+        self.cache.invalidate((group, date), (group, "latest"))
+
+        logger.debug(f"Changes for group {group} updated in the database")
         return changes, date
 
+    def update_vardays(self, groups) -> dict[str, tuple[str, datetime.date] | bool | None] | bool | None:
+        # Скачиваем и разбираем pdf один раз за цикл, затем обновляем изменения для каждого класса
+        return self.update_document(self.fetch_varday(), groups)
+
+    def update_document(self, document, groups) -> dict[str, tuple[str, datetime.date] | bool | None] | bool | None:
+        if document is None:
+            return None
+
+        if not document:
+            return False
+
+        text, date = document
+        with metrics.extract_seconds.time():
+            changes = extract_changes(text, groups)
+        return {group: self.update_group(group, changes.get(group), date) for group in groups}
+
+    def update_varday(self, group) -> tuple[str, datetime.date] | bool | None:
+        logger.debug(f"Retrieving variable day schedule for group: {group}")
+        document = self.fetch_varday()
+        if document is None:
+            if self.document is None:
+                # Файл уже в архиве и разобран, изменения в бд актуальны
+                return True
+
+            document = self.document
+
+        if not document:
+            return False
+
+        text, date = document
+        return self.update_group(group, extract_changes(text, [group]).get(group), date)
+
+    def __check_version(self) -> None:
+        now = time.monotonic()
+        if now - self.version_checked < self.version_interval:
+            return
+
+        self.version_checked = now
+        version = self.database.data_version("Changes")
+        if version != self.changes_version:
+            self.cache.clear()
+            self.changes_version = version
+
     def get_varday(self,
                    group,
                    date: datetime.date = datetime.date.today()+timedelta(days=1)
                    ) -> tuple[str, datetime.date] | None:
-        self.cursor.execute('''SELECT * FROM Changes WHERE group_for=? AND date=? LIMIT 1''',
-                            (group, date.strftime("%Y-%m-%d")))
-        data = self.cursor.fetchone()
-        if data:
-            return data[2], data[1]
+        self.__check_version()
+        cached = self.cache.get((group, date))
+        if cached is not MISSING:
+            return cached
 
-        else:
-            return None
+        with self.database.read() as cursor:
+            cursor.execute('''SELECT changes, date FROM Changes WHERE group_for=? AND date=? LIMIT 1''',
+                           (group, date.strftime("%Y-%m-%d")))
+            data = cursor.fetchone()
+        result = (data[0], data[1]) if data else None
+        self.cache.put((group, date), result)
+        return result
 
     def get_last_varday(self, group) -> tuple[str, datetime.date] | bool | None:
         logger.debug(f"Retrieving last variable day schedule for group: {group}")
+        self.__check_version()
+        cached = self.cache.get((group, "latest"))
+        if cached is not MISSING:
+            return cached
+
         query = """
            SELECT date, changes, group_for
            FROM Changes
@@ -114,52 +252,55 @@ class Scrapper:
         try:
             # Подключение к базе данных
 
-            self.cursor.execute(query, (group,))
+            with self.database.read() as cursor:
+                cursor.execute(query, (group,))
+                result = cursor.fetchone()
 
-            result = self.cursor.fetchone()
             if result:
-                return (result[1], datetime.datetime.strptime(result[0], "%Y-%m-%d").date())
+                result = (result[1], datetime.datetime.strptime(result[0], "%Y-%m-%d").date())
             else:
-                return False
+                result = False
+
+            self.cache.put((group, "latest"), result)
+            return result
         except Exception as e:
             return False
 
-    @staticmethod
-    def __get_changes_for_group(text, group):
-        logger.debug(f"Searching for changes for group {group}")
-        pattern = rf"({group})\s*-\s*([^\n]+)"
-        matches = re.findall(pattern, text.lower())
-
-        if matches:
-            logger.debug(f"Changes found for group {group}")
-            return matches[0][1]
-        else:
-            logger.debug(f"No changes found for group {group}")
-            return None
+    def get_last_date(self) -> datetime.date | None:
+        with self.database.read() as cursor:
+            cursor.execute("""SELECT MAX(date) FROM Changes""")
+            result = cursor.fetchone()
+        if result and result[0]:
+            return datetime.datetime.strptime(result[0], "%Y-%m-%d").date()
+
+        return None
 
     @staticmethod
-    def __get_date_from_text(text, year = None):
+    def __get_date_from_text(text, today: datetime.date = None):
         logger.debug("Extracting date from text")
-        if year is None:
-            year = datetime.date.today().year
-
+        if today is None:
+            today = datetime.date.today()
 
-        match = re.search(r'(\d{1,2})\.(\d{1,2})', text)
-        
-        if match:
+        for match in re.finditer(r'(\d{1,2})\.(\d{1,2})', text):
             day, month = map(int, match.groups())
-            date = datetime.date(year, month, day)
+            # Переход через новый год: в декабре выкладывают изменения на январь, а в январе ещё могут лежать декабрьские
+            year = today.year
+            if today.month == 12 and month == 1:
+                year += 1
+            elif today.month == 1 and month == 12:
+                year -= 1
+
+            try:
+                date = datetime.date(year, month, day)
+            except ValueError:
+                continue
+
             logger.debug(f"Date extracted: {date}")
-            
             return date
 
         logger.warning("No date found in the text")
         return None
 
-    def __del__(self):
-        logger.debug("Closing database connection")
-        self.conn.close()
-
 if __name__ == '__main__':
     scrapper = Scrapper()
     print(scrapper.update_varday("5в"))
@@ -1,52 +1,47 @@
-import os
 import threading
 from typing import List
 import telebot
 from scrapper import Scrapper
 import logging
-import sqlite3
 import datetime
 import json
 from telebot_dialogue import Dialogue, DialogueManager
 from settings import settings, logger
+from database import Database
+from dispatcher import Dispatcher
+from broadcast import Broadcaster
+from archive import ArchiveEntry
+from dialogue_store import DialogueStore
+from router import CallbackRouter, callback_data
+from keywords import KeywordIndex, normalize
 
 db = settings["db"]
-dialogue_manager = DialogueManager()
 
 logger.setLevel(logging.INFO)
 
 GROUPS = settings["groups"]
 
-scrapper = Scrapper()
-
-conn = sqlite3.connect(db, check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute(
-    """CREATE TABLE IF NOT EXISTS Changes(
-    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, 
-    date TEXT NOT NULL, 
-    changes TEXT NOT NULL, 
-    group_for TEXT NOT NULL)""")
-
-cursor.execute(
-    """CREATE TABLE IF NOT EXISTS Subs(
-    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, 
-    user_id INTEGER NOT NULL, 
-    subgroup TEXT NOT NULL, 
-    last_update TEXT NOT NULL, 
-    last_change TEXT NOT NULL)""")
-
-cursor.execute(
-    """CREATE TABLE IF NOT EXISTS Users(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL)""")
-
-conn.commit()
+database = Database(db, size=settings["db_pool_size"] or 8)
+# Незавершённые диалоги истекают и вытесняются; с dialogue_persist они хранятся в бд и общие для всех процессов
+dialogue_manager = DialogueStore(ttl=settings["dialogue_ttl"] or 3600,
+                                 max_size=settings["dialogue_max_size"] or 10000,
+                                 database=database if settings["dialogue_persist"] else None)
+scrapper = Scrapper(db=database)
+archive = scrapper.archive
+keyword_index = KeywordIndex(database)
 
 
 TOKEN = settings["token"]
 
 
-# Создаём экземпляр бота
-bot = telebot.TeleBot(TOKEN)
+# Создаём экземпляр бота. В режиме вебхука обработчики выполняются прямо в его воркерах: пул потоков telebot
+# без ограничений забрал бы обновления из очередей, и пропали бы и обратное давление, и порядок внутри чата
+bot = telebot.TeleBot(TOKEN, threaded=settings["runtime"] != "webhook")
+router = CallbackRouter()
+router.register(bot)
+dispatcher = Dispatcher(bot, database, workers=settings["dispatcher_workers"] or 8, rate=settings["send_rate"] or 30,
+                        retention_days=settings["outbox_retention_days"] or 7)
+broadcaster = Broadcaster(database, dispatcher, page_size=settings["broadcast_page_size"] or 500)
 
 
 class Subscribe:
@@ -74,10 +69,13 @@ def extract_arg(arg: str) -> List[str]:
 
 def get_subscriptions(user_id: int) -> [Subscribe]:
     logger.debug(f"Getting subscriptions for user {user_id}")
-    cursor.execute("""SELECT subgroup, last_update, last_change FROM Subs WHERE user_id=?""",
-                   (user_id,))
+    with database.read() as cursor:
+        cursor.execute("""SELECT subgroup, last_update, last_change FROM Subs WHERE user_id=?""",
+                       (user_id,))
+        rows = cursor.fetchall()
+
     res = []
-    for sub in cursor.fetchall():
+    for sub in rows:
         res.append(Subscribe(user_id, sub[0], datetime.datetime.strptime(sub[1], "%Y-%m-%d").date(), sub[2]))
 
     return res
@@ -85,56 +83,94 @@ def get_subscriptions(user_id: int) -> [Subscribe]:
 
 def find_subscription(user_id, group):
     logger.info(f"Finding subscription for user {user_id} and group {group}")
-    subscriptions = get_subscriptions(user_id)
-    for sub in subscriptions:
-        if sub.subgroup == group:
-            return sub
+    with database.read() as cursor:
+        cursor.execute("""SELECT last_update, last_change FROM Subs WHERE user_id=? AND subgroup=?""",
+                       (user_id, group))
+        sub = cursor.fetchone()
+    if sub:
+        return Subscribe(user_id, group, datetime.datetime.strptime(sub[0], "%Y-%m-%d").date(), sub[1])
 
     return None
 
 
 def add_subscription(user_id: int, subgroup: str) -> None:
     logger.info(f"Adding subscription for user {user_id} and group {subgroup}")
-    cursor.execute("""INSERT INTO Subs(user_id, subgroup, last_update, last_change) VALUES(?,?,?,?)""",
-                   (user_id, subgroup, datetime.date.today().strftime("%Y-%m-%d"), scrapper.get_varday(subgroup, datetime.date.today())[0] if scrapper.get_varday(subgroup, datetime.date.today()) else "None",))
-    conn.commit()
+    changes = scrapper.get_varday(subgroup, datetime.date.today())
+    with database.write() as cursor:
+        cursor.execute("""INSERT INTO Subs(user_id, subgroup, last_update, last_change) VALUES(?,?,?,?)""",
+                       (user_id, subgroup, datetime.date.today().strftime("%Y-%m-%d"), changes[0] if changes else "None",))
 
 def check_subscription(subscription: Subscribe) -> bool:
     logger.info(f"Checking subscription for user {subscription.user_id} and group {subscription.subgroup}")
-    cursor.execute("""SELECT * FROM Subs WHERE user_id=? AND subgroup=?""",
-                   (subscription.user_id, subscription.subgroup))
-    return bool(cursor.fetchone())
+    with database.read() as cursor:
+        cursor.execute("""SELECT 1 FROM Subs WHERE user_id=? AND subgroup=?""",
+                       (subscription.user_id, subscription.subgroup))
+        return bool(cursor.fetchone())
 
 def delete_subscription(subscription: Subscribe) -> None:
     logger.info(f"Deleting subscription for user {subscription.user_id} and group {subscription.subgroup}")
-    cursor.execute("""DELETE FROM Subs WHERE user_id=? AND subgroup=?""",
-                   (subscription.user_id, subscription.subgroup))
-    conn.commit()
+    with database.write() as cursor:
+        cursor.execute("""DELETE FROM Subs WHERE user_id=? AND subgroup=?""",
+                       (subscription.user_id, subscription.subgroup))
 
 def get_subscribers(group: str) -> List[Subscribe]:
     logger.debug(f"Getting subscriptions for group {group}")
-    cursor.execute("""SELECT * FROM Subs WHERE subgroup=?""",
-                   (group,))
+    with database.read() as cursor:
+        cursor.execute("""SELECT * FROM Subs WHERE subgroup=?""",
+                       (group,))
+        rows = cursor.fetchall()
+
     res = []
-    for sub in cursor.fetchall():
+    for sub in rows:
         res.append(Subscribe(int(sub[1]), sub[2], datetime.datetime.strptime(sub[3], "%Y-%m-%d").date(), sub[4]))
 
     return res
 
+def get_pending_notifications() -> List[tuple[Subscribe, str, datetime.date]]:
+    logger.debug("Getting subscriptions with new changes")
+    # Одним запросом сравниваем подписки с последними изменениями их классов
+    with database.read() as cursor:
+        cursor.execute("""
+            WITH latest AS (SELECT group_for, MAX(date) AS date FROM Changes GROUP BY group_for)
+            SELECT s.user_id, s.subgroup, s.last_update, s.last_change, c.changes, c.date
+            FROM latest l
+            JOIN Changes c ON c.group_for = l.group_for AND c.date = l.date
+            JOIN Subs s ON s.subgroup = l.group_for
+            WHERE c.date > s.last_update OR c.changes != s.last_change""")
+        rows = cursor.fetchall()
+
+    res = []
+    for sub in rows:
+        res.append((Subscribe(int(sub[0]), sub[1], datetime.datetime.strptime(sub[2], "%Y-%m-%d").date(), sub[3]),
+                    sub[4], datetime.datetime.strptime(sub[5], "%Y-%m-%d").date()))
+
+    return res
+
 def update_subscription(subscription: Subscribe, new_changes, new_date: datetime.date) -> bool:
     logger.info(f"Updating subscription for user {subscription.user_id} and group {subscription.subgroup}")
-    cursor.execute("""UPDATE Subs SET last_change=?, last_update=? WHERE user_id=? AND subgroup=?""",
-                   (new_changes, new_date.strftime("%Y-%m-%d"), subscription.user_id, subscription.subgroup))
-    conn.commit()
-    return bool(cursor.rowcount)
+    with database.write() as cursor:
+        cursor.execute("""UPDATE Subs SET last_change=?, last_update=? WHERE user_id=? AND subgroup=?""",
+                       (new_changes, new_date.strftime("%Y-%m-%d"), subscription.user_id, subscription.subgroup))
+        return bool(cursor.rowcount)
+
+def groups_keyboard(action: str, *args, groups: List[str] = None, back: str = "cancel_info"):
+    # Выбор класса кнопками: класс дописывается в конец callback_data вслед за остальными параметрами шага
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=4)
+    keyboard.add(*(telebot.types.InlineKeyboardButton(group, callback_data=callback_data(action, *args, group))
+                   for group in (GROUPS if groups is None else groups)))
+    keyboard.row(telebot.types.InlineKeyboardButton("⬅️ Назад", callback_data=back))
+    return keyboard
 
 # Команда /start
 @bot.message_handler(commands=["start"])
 def start_command(message):
     logger.info(f"User {message.from_user.id} started the bot")
-    cursor.execute("""SELECT * FROM Users WHERE user_id=?""",
-                   (message.from_user.id,))
-    if not cursor.fetchone():
+    with database.read() as cursor:
+        cursor.execute("""SELECT 1 FROM Users WHERE user_id=?""",
+                       (message.from_user.id,))
+        user = cursor.fetchone()
+
+    if not user:
         bot.send_message(message.chat.id, '''Привет! 👋  
     Я ваш помощник для отслеживания изменений в расписании.  
     
@@ -149,9 +185,9 @@ def start_command(message):
     Исходный код: https://github.com/Tiver211/varday_scrapper
     Данные относятся только к МОУ "Лицей №1" г.Всеволожска. 
     Разработан как личный проект и не связан с администрацией школы.''')
-        cursor.execute("""INSERT INTO Users(user_id) VALUES(?)""",
-                       (message.from_user.id,))
-        conn.commit()
+        with database.write() as cursor:
+            cursor.execute("""INSERT INTO Users(user_id) VALUES(?)""",
+                           (message.from_user.id,))
 
     menu(message=message)
 
@@ -172,7 +208,7 @@ def menu(message):
     bot.send_message(message.chat.id, "Меню:", reply_markup=keyboard)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "subscribe_controll")
+@router.route("subscribe_controll")
 def subscribes_control(call):
     logger.info(f"User {call.from_user.id} opened the subscribes control")
     dialogue_manager.finish_dialogue(call.message.chat.id)
@@ -183,43 +219,43 @@ def subscribes_control(call):
     button_unsubscribe = telebot.types.InlineKeyboardButton(
         text="➖ отписаться от уведомлений",
         callback_data="unsubscribe_menu")
+    button_keyword = telebot.types.InlineKeyboardButton(
+        text="🔎 подписаться на слово",
+        callback_data="keyword_menu")
+    button_keyword_unsubscribe = telebot.types.InlineKeyboardButton(
+        text="✖️ отписаться от слова",
+        callback_data="keyword_unsubscribe_menu")
     button_cancel = telebot.types.InlineKeyboardButton(
         text="⬅️ назад",
         callback_data="cancel_main")
     keyboard.add(button_subscribe, button_unsubscribe)
+    keyboard.add(button_keyword, button_keyword_unsubscribe)
     keyboard.row(button_cancel)
 
     subs = get_subscriptions(call.message.chat.id)
     answer_groups = ""
     for subscription in subs:
         answer_groups += f" {subscription.subgroup}     последнее обновление - {subscription.last_update.strftime("%d.%m.%Y")}\n"
+    keywords = ", ".join(keyword for _, keyword in keyword_index.subscriptions(call.message.chat.id))
     ans_message = f"активные подписки: \n{answer_groups}"
+    if keywords:
+        ans_message += f"\nслова: {keywords}"
     bot.send_message(call.message.chat.id, ans_message, reply_markup=keyboard)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "unsubscribe_menu")
+@router.route("unsubscribe_menu")
 def unsubscribe_menu(call):
     logger.info(f"User {call.from_user.id} opened the unsubscribe menu")
-    keyboard = telebot.types.InlineKeyboardMarkup()
-    groups = get_subscriptions(call.message.chat.id)
-    for group in groups:
-        keyboard.add(telebot.types.InlineKeyboardButton(str(group), callback_data=str(group)+"_unsubscribe"))
-    keyboard.add(telebot.types.InlineKeyboardButton("назад", callback_data="cancel"+"_unsubscribe"))
-
+    groups = [subscription.subgroup for subscription in get_subscriptions(call.message.chat.id)]
     bot.send_message(
         call.message.chat.id,
         "Выберите класс для отписки:",
-        reply_markup=keyboard
+        reply_markup=groups_keyboard("unsub", groups=groups, back="subscribe_controll")
     )
 
-@bot.callback_query_handler(func=lambda call: "_unsubscribe" in call.data)
-def unsubscribe_group(call):
-    logger.info(f"User {call.from_user.id} unsubscribed from group {call.data.split('_')[0]}")
-    group = call.data.split("_")[0]
-    if group == "cancel":
-        subscribes_control(call)
-        return
-
+@router.route("unsub")
+def unsubscribe_group(call, group):
+    logger.info(f"User {call.from_user.id} unsubscribed from group {group}")
     sub = find_subscription(call.message.chat.id, group)
     if sub:
         delete_subscription(sub)
@@ -232,32 +268,84 @@ def unsubscribe_group(call):
     subscribes_control(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "subscribe_menu")
+@router.route("subscribe_menu")
 def subscribe_menu(call):
     logger.info(f"User {call.from_user.id} opened the subscribe menu")
-    dialogue = Dialogue(call.message.chat.id, handler=subscribe_group)
-    dialogue_manager.add_dialogue(dialogue)
-    bot.send_message(call.message.chat.id, "Напищите класс для подписки (например 8в):")
+    subscribed = {subscription.subgroup for subscription in get_subscriptions(call.message.chat.id)}
+    bot.send_message(call.message.chat.id, "Выберите класс для подписки:",
+                     reply_markup=groups_keyboard("sub", groups=[group for group in GROUPS if group not in subscribed],
+                                                  back="subscribe_controll"))
 
 
-def subscribe_group(message, dialogue: Dialogue):
-    logger.info(f"User {message.from_user.id} subscribed to group {message.text}")
-    sub = find_subscription(message.from_user.id, message.text)
+@router.route("sub")
+def subscribe_group(call, group):
+    logger.info(f"User {call.from_user.id} subscribed to group {group}")
+    sub = find_subscription(call.message.chat.id, group)
     if sub:
-        bot.send_message(message.chat.id, f"Вы уже подписаны на уведомления для класса {message.text}")
+        bot.send_message(call.message.chat.id, f"Вы уже подписаны на уведомления для класса {group}")
         return
 
-    if message.text not in GROUPS:
-        bot.send_message(message.chat.id, "Такого класса нет в списке")
+    if group not in GROUPS:
+        bot.send_message(call.message.chat.id, "Такого класса нет в списке")
         return
 
-    add_subscription(message.from_user.id, message.text)
-    bot.send_message(message.chat.id, f"Вы успешно подписаны на уведомления для класса {message.text}")
-    menu(message)
+    add_subscription(call.message.chat.id, group)
+    bot.send_message(call.message.chat.id, f"Вы успешно подписаны на уведомления для класса {group}")
+    menu(call.message)
+
+
+@router.route("keyword_menu")
+def keyword_menu(call):
+    logger.info(f"User {call.from_user.id} opened the keyword subscribe menu")
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.add(telebot.types.InlineKeyboardButton("⬅️ назад", callback_data="subscribe_controll"))
+    dialogue = Dialogue(call.message.chat.id, handler=subscribe_keyword)
+    dialogue_manager.add_dialogue(dialogue, force=True)
+    bot.send_message(call.message.chat.id,
+                     "Напишите фамилию учителя, кабинет или предмет, о которых нужно сообщать во всех классах:",
+                     reply_markup=keyboard)
+
+
+def subscribe_keyword(message, dialogue: Dialogue):
+    logger.info(f"User {message.from_user.id} subscribed to keyword {message.text}")
+    keyword = normalize(message.text)
+    if len(keyword) < 3:
+        bot.send_message(message.chat.id, "Слишком короткое слово, напишите хотя бы 3 буквы")
+        return
+
+    if len(keyword_index.subscriptions(message.from_user.id)) >= (settings["max_keywords"] or 10):
+        bot.send_message(message.chat.id, "Достигнут лимит подписок на слова, сначала отпишитесь от какого-нибудь")
+    elif keyword_index.subscribe(message.from_user.id, keyword):
+        bot.send_message(message.chat.id, f"Вы будете получать изменения, где упоминается «{keyword}»")
+    else:
+        bot.send_message(message.chat.id, f"Вы уже подписаны на «{keyword}»")
+
     dialogue_manager.finish_dialogue(message.from_user.id)
+    menu(message)
+
+
+@router.route("keyword_unsubscribe_menu")
+def keyword_unsubscribe_menu(call):
+    logger.info(f"User {call.from_user.id} opened the keyword unsubscribe menu")
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    for subscription_id, keyword in keyword_index.subscriptions(call.message.chat.id):
+        keyboard.add(telebot.types.InlineKeyboardButton(keyword, callback_data=callback_data("kwdel", subscription_id)))
+    keyboard.add(telebot.types.InlineKeyboardButton("⬅️ назад", callback_data="subscribe_controll"))
+    bot.send_message(call.message.chat.id, "Выберите слово для отписки:", reply_markup=keyboard)
+
+
+@router.route("kwdel")
+def keyword_unsubscribe(call, subscription_id):
+    keyword = keyword_index.unsubscribe(call.message.chat.id, int(subscription_id))
+    logger.info(f"User {call.from_user.id} unsubscribed from keyword {keyword}")
+    if keyword:
+        bot.send_message(call.message.chat.id, f"Вы отписались от «{keyword}»")
+    else:
+        bot.send_message(call.message.chat.id, "Вы не подписаны на это слово")
+    subscribes_control(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_info_control")
+@router.route("get_info_control")
 def get_info_control(call):
     logger.info(f"User {call.from_user.id} opened the get info control")
     keyboard = telebot.types.InlineKeyboardMarkup()
@@ -268,7 +356,7 @@ def get_info_control(call):
 
     bot.send_message(call.message.chat.id, "Какие изменения вы хотите получить?", reply_markup=keyboard)
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_pdf")
+@router.route("get_pdf")
 def get_pdf_menu(call):
     logger.info(f"User {call.message.chat.id} opened get pdf menu")
     keyboard = telebot.types.InlineKeyboardMarkup()
@@ -277,34 +365,40 @@ def get_pdf_menu(call):
 
     bot.send_message(call.message.chat.id, "Введите дату в формате гггг.мм.дд, или получите последний файл", reply_markup=keyboard)
     dialogue = Dialogue(call.message.chat.id, handler=send_pdf_by_date)
-    dialogue_manager.add_dialogue(dialogue)
+    dialogue_manager.add_dialogue(dialogue, force=True)
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_info")
+@router.route("cancel_info")
 def cancel_info(call):
     logger.info(f"User {call.from_user.id} canceled info control")
     dialogue_manager.finish_dialogue(call.message.chat.id)
     get_info_control(call)
 
-@bot.callback_query_handler(func=lambda call: call.data == "download_pdf_last")
+def send_archived_pdf(chat_id, entry: ArchiveEntry, reply_markup=None):
+    # Файл, уже загруженный в telegram, отправляем по file_id без повторной загрузки
+    if entry.file_id:
+        try:
+            bot.send_document(chat_id, document=entry.file_id, reply_markup=reply_markup)
+            return
+
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f"Cached file_id for {entry.date} rejected: {e}")
+            archive.set_file_id(entry, None)
+
+    with open(entry.path, 'rb') as pdf_file:
+        sent = bot.send_document(chat_id, document=pdf_file, reply_markup=reply_markup)
+    archive.set_file_id(entry, sent.document.file_id)
+
+
+@router.route("download_pdf_last")
 def download_pdf_last(call):
     logger.info(f"User {call.from_user.id} downloaded last pdf")
-    files = [f for f in os.listdir("pdf_files") if f.endswith('.pdf') and f != 'temp.pdf']
-    date_files = {}
     dialogue_manager.finish_dialogue(call.message.chat.id)
-    for file in files:
-        try:
-            date = datetime.datetime.strptime(file.replace('.pdf', ''), '%Y-%m-%d')
-            date_files[file] = date
-        except ValueError:
-            continue
-
-    if not date_files:
+    entry = archive.latest()
+    if not entry:
         return None
 
-    latest_file = max(date_files, key=date_files.get)
     try:
-        with open(os.path.join("pdf_files", latest_file), 'rb') as pdf_file:
-            bot.send_document(call.message.chat.id, document=pdf_file)
+        send_archived_pdf(call.message.chat.id, entry)
 
     except Exception as e:
         bot.send_message(call.message.chat.id, f"Ошибка при отправке файла: {e}")
@@ -312,21 +406,20 @@ def download_pdf_last(call):
 def send_pdf_by_date(message, dialogue: Dialogue):
     logger.info(f"User {message.from_user.id} downloaded pdf by date {message.text}")
     try:
-        date = datetime.datetime.strptime(message.text, "%Y.%m.%d").strftime("%Y-%m-%d")
+        date = datetime.datetime.strptime(message.text, "%Y.%m.%d").date()
 
     except ValueError:
         bot.send_message(dialogue.user_id, "Неверный формат даты, пожалуста введите дату в формате гггг.мм.дд")
         return
-    path = os.path.join("pdf_files", date+".pdf")
-    if not os.path.exists(path):
+    entry = archive.get(date)
+    if not entry:
         bot.send_message(dialogue.user_id, "Файла на эту дату не существует, пожалуста выберите другую")
         return
 
     keyboard = telebot.types.InlineKeyboardMarkup()
     keyboard.add(telebot.types.InlineKeyboardButton("⬅️ Назад", callback_data="cancel_info"))
     try:
-        with open(path, 'rb') as pdf_file:
-            bot.send_document(dialogue.user_id, document=pdf_file, reply_markup=keyboard)
+        send_archived_pdf(dialogue.user_id, entry, reply_markup=keyboard)
 
     except Exception as e:
         bot.send_message(dialogue.user_id, f"Ошибка при отправке файла: {e}", reply_markup=keyboard)
@@ -335,24 +428,23 @@ def send_pdf_by_date(message, dialogue: Dialogue):
     dialogue_manager.finish_dialogue(dialogue.user_id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_main")
+@router.route("cancel_main")
 def cancel_main(call):
     logger.info(f"User {call.from_user.id} canceled main menu")
     dialogue_manager.finish_dialogue(call.message.chat.id)
     menu(call.message)
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_last_changes")
+@router.route("get_last_changes")
 def get_latest_change(call):
     logger.info(f"User {call.from_user.id} opened get last changes menu")
-    dialogue = Dialogue(call.message.chat.id, handler=get_last_change_by_group)
-    dialogue_manager.add_dialogue(dialogue)
-    bot.send_message(call.message.chat.id, "В каком классе вы хотите получить последние изменения?")
+    bot.send_message(call.message.chat.id, "В каком классе вы хотите получить последние изменения?",
+                     reply_markup=groups_keyboard("last"))
 
-def get_last_change_by_group(message, dialogue: Dialogue):
-    logger.info(f"User {message.from_user.id} downloaded last changes by group {message.text}")
-    group = message.text
+@router.route("last")
+def get_last_change_by_group(call, group):
+    logger.info(f"User {call.from_user.id} downloaded last changes by group {group}")
     if group not in GROUPS:
-        bot.send_message(dialogue.user_id, "Такого класса нет в списке")
+        bot.send_message(call.message.chat.id, "Такого класса нет в списке")
         return
 
     result = scrapper.get_last_varday(group)
@@ -361,19 +453,17 @@ def get_last_change_by_group(message, dialogue: Dialogue):
     keyboard.add(telebot.types.InlineKeyboardButton("⬅️ Назад", callback_data="cancel_info"))
 
     if result:
-        date, change = result
-        bot.send_message(message.chat.id, f"Последнее изменение в классе {message.text}:\n{date} - {change}",
+        change, date = result
+        bot.send_message(call.message.chat.id, f"Последнее изменение в классе {group}:\n{date} - {change}",
                          reply_markup=keyboard)
     else:
-        bot.send_message(dialogue.user_id, "В данном классе нет изменений", reply_markup=keyboard)
-
-    dialogue_manager.finish_dialogue(dialogue.user_id)
+        bot.send_message(call.message.chat.id, "В данном классе нет изменений", reply_markup=keyboard)
 
-@bot.callback_query_handler(func=lambda call: call.data == "get_changes_by_date")
+@router.route("get_changes_by_date")
 def get_changes_by_date_menu(call):
     logger.info(f"User {call.from_user.id} opened get changes by date menu")
     dialogue = Dialogue(call.message.chat.id, handler=get_date_for_changes)
-    dialogue_manager.add_dialogue(dialogue)
+    dialogue_manager.add_dialogue(dialogue, force=True)
     keyboard = telebot.types.InlineKeyboardMarkup()
     keyboard.add(telebot.types.InlineKeyboardButton("🗓️ завтра", callback_data="changes_tomorrow"))
     keyboard.add(telebot.types.InlineKeyboardButton("🗓️ сегодня", callback_data="changes_today"))
@@ -383,35 +473,22 @@ def get_changes_by_date_menu(call):
                      "ответ дайте в формате гггг.мм.дд, или выберите вариант из меню",
                      reply_markup=keyboard)
 
-@bot.callback_query_handler(func=lambda call: call.data == "changes_today")
+def ask_group_for_changes(chat_id: int, date: datetime.date):
+    # Дата уже выбрана, дальше диалог не нужен: она едет в callback_data кнопок с классами
+    dialogue_manager.finish_dialogue(chat_id)
+    bot.send_message(chat_id, f"Изменения за {date.strftime('%d.%m.%Y')}, выберите класс:",
+                     reply_markup=groups_keyboard("chg", date.strftime("%Y%m%d")))
+
+@router.route("changes_today")
 def changes_today(call):
     logger.info(f"User {call.from_user.id} requested changes today")
-    if not dialogue_manager.find_dialogue(call.message.chat.id):
-        dialogue = Dialogue(call.message.chat.id, handler=get_group_for_chages)
-        dialogue.update_context("date", datetime.date.today())
-        dialogue_manager.add_dialogue(dialogue)
-
-    else:
-        with dialogue_manager.update(call.message.chat.id) as dialogue:
-            dialogue.handler = get_group_for_chages
-            dialogue.update_context("date", datetime.date.today())
-
-    bot.send_message(call.message.chat.id, "Теперь введите класс:")
+    ask_group_for_changes(call.message.chat.id, datetime.date.today())
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "changes_tomorrow")
+@router.route("changes_tomorrow")
 def changes_tomorrow(call):
     logger.info(f"User {call.from_user.id} requested changes tomorrow")
-    if not dialogue_manager.find_dialogue(call.message.chat.id):
-        dialogue = Dialogue(call.message.chat.id, handler=get_group_for_chages)
-        dialogue.update_context("date", datetime.date.today() + datetime.timedelta(days=1))
-        dialogue_manager.add_dialogue(dialogue)
-
-    else:
-        with dialogue_manager.update(call.message.chat.id) as dialogue:
-            dialogue.handler = get_group_for_chages
-            dialogue.update_context("date", datetime.date.today() + datetime.timedelta(days=1))
-    bot.send_message(call.message.chat.id, "Теперь введите класс:")
+    ask_group_for_changes(call.message.chat.id, datetime.date.today() + datetime.timedelta(days=1))
 
 
 def get_date_for_changes(message: telebot.types.Message, dialogue: Dialogue):
@@ -423,40 +500,25 @@ def get_date_for_changes(message: telebot.types.Message, dialogue: Dialogue):
         bot.send_message(dialogue.user_id, "Неверный формат даты. Пожалуйста, введите дату в формате гггг.мм.дд")
         return
 
-    with dialogue_manager.update(dialogue.user_id) as dialogue:
-        dialogue.handler = get_group_for_chages
-        dialogue.update_context("date", date)
-        dialogue.update_context("group", None)
-    bot.send_message(message.chat.id, "Теперь введите класс:")
+    ask_group_for_changes(message.chat.id, date)
 
-def get_group_for_chages(message, dialogue: Dialogue):
-    logger.info(f"User {message.from_user.id} downloaded changes by group {message.text}")
-    group = message.text
+@router.route("chg")
+def get_changes_by_date_group(call, date, group):
+    date = datetime.datetime.strptime(date, "%Y%m%d").date()
+    logger.info(f"User {call.from_user.id} requested changes by date {date} and group {group}")
     if group not in GROUPS:
-        bot.send_message(dialogue.user_id, "Такого класса нет в списке")
+        bot.send_message(call.message.chat.id, "Такого класса нет в списке")
         return
 
-    with dialogue_manager.update(dialogue.user_id) as dialogue:
-        dialogue.update_context("group", group)
-
-    get_changes_by_date_group(dialogue_manager.find_dialogue(dialogue.user_id))
-
-
-def get_changes_by_date_group(dialogue):
-    group = dialogue.get_context("group")
-    date = dialogue.get_context("date")
-    logger.info(f"User {dialogue.user_id} requested changes by date {date} and group {group}")
     changes = scrapper.get_varday(group, date)
     keyboard = telebot.types.InlineKeyboardMarkup()
     keyboard.add(telebot.types.InlineKeyboardButton("⬅️️ Назад", callback_data="cancel_info"))
     if changes:
         change, date = changes
-        bot.send_message(dialogue.user_id, f"Изменения за {date} класса {group}: \n{change}", reply_markup=keyboard)
+        bot.send_message(call.message.chat.id, f"Изменения за {date} класса {group}: \n{change}", reply_markup=keyboard)
 
     else:
-        bot.send_message(dialogue.user_id, "В данном классе за эту дату нет изменений", reply_markup=keyboard)
-
-    dialogue_manager.finish_dialogue(dialogue.user_id)
+        bot.send_message(call.message.chat.id, "В данном классе за эту дату нет изменений", reply_markup=keyboard)
 
 @bot.message_handler(content_types=["text"], func=lambda message: not message.text.startswith("/"))
 def multihandler(message):
@@ -5,42 +5,166 @@ from telebot import TeleBot
 from time import sleep
 from tg_bot import *
 from scrapper import Scrapper
-from tg_bot import Subscribe, bot, scrapper, db
+from tg_bot import Subscribe, bot, scrapper, db, dispatcher, broadcaster, keyword_index
+from keywords import KeywordIndex
+from broadcast import Broadcaster
+from dispatcher import Dispatcher
+from scheduler import AdaptiveScheduler
+from lease import Lease
+import metrics
 from settings import settings
 
 GROUPS = settings["groups"]
 
 # Функция отправки сообщений, вызываемая скраппером
 class TgHandler:
-    def __init__(self, bot: TeleBot, db, scrapper: Scrapper):
+    def __init__(self, bot: TeleBot, db, scrapper: Scrapper, dispatcher: Dispatcher = dispatcher,
+                 scheduler: AdaptiveScheduler = None, lease: Lease = None,
+                 broadcaster: Broadcaster = broadcaster, keyword_index: KeywordIndex = keyword_index):
         self.bot = bot
         self.db = db
         self.scrapper = scrapper
+        self.dispatcher = dispatcher
+        self.scheduler = scheduler
+        self.broadcaster = broadcaster
+        self.keyword_index = keyword_index
+        # Если процессов со скраппером несколько, работает только держатель аренды
+        self.lease = lease
+        if lease is not None:
+            self.dispatcher.lease = lease
+            self.broadcaster.lease = lease
+
+    def make_scheduler(self, period: int) -> AdaptiveScheduler:
+        if self.scheduler is None:
+            self.scheduler = AdaptiveScheduler(min_period=period, max_period=settings["max_cycle_period"] or 1800)
+            self.scheduler.learn_from_archive("pdf_files")
+
+        return self.scheduler
 
     def start_cycle(self, period: int):
+        if self.lease is not None:
+            self.lease.start()
+        self.dispatcher.start()
+        self.broadcaster.start()
+        scheduler = self.make_scheduler(period)
         while True:
-            self.run_cycle()
-            sleep(period)
+            if self.lease is not None and not self.lease.is_leader():
+                sleep(self.lease.ttl / 3)
+                continue
+
+            if scheduler.breaker.allow():
+                try:
+                    result = self.run_cycle()
+                    scheduler.record_fetch(self.scrapper.status_code in (200, 304), isinstance(result, dict))
+                except Exception as e:
+                    logger.error(f"Scrape cycle failed: {e}")
+                    scheduler.record_fetch(False, False)
+
+            sleep(scheduler.next_delay())
 
     def run_cycle(self):
-        for group in GROUPS:
-            self.scrapper.update_varday(group)
-            changes = self.scrapper.get_last_varday(group)
-            if not changes:
+        result = self.scrapper.update_vardays(GROUPS)
+        self.notify_subscribers()
+        if isinstance(result, dict):
+            # Вышел новый файл: ищем ключевые слова по всему тексту, а не только по строкам своих классов
+            self.notify_keywords(self.scrapper.document)
+        return result
+
+    def notify_subscribers(self):
+        self.send_messages(get_pending_notifications())
+
+    def send_messages(self, notifications: list[tuple[Subscribe, str, datetime.date]]):
+        if not notifications:
+            return
+
+        # Все изменения одного пользователя за цикл собираем в одно сообщение
+        digests = {}
+        updates = []
+        for subsctiption, message, date in notifications:
+            digests.setdefault(subsctiption.user_id, []).append(
+                f'{subsctiption.subgroup} на {date.strftime("%d.%m.%Y")}: {message}')
+            updates.append((message, date.strftime("%Y-%m-%d"), subsctiption.user_id, subsctiption.subgroup))
+
+        messages = []
+        for user_id, lines in digests.items():
+            if len(lines) == 1:
+                text = f'Появилсь изменения для класса {lines[0]}'
+            else:
+                text = "Появилсь изменения для классов:\n\n" + "\n\n".join(lines)
+
+            # Даже одно изменение может не влезть в 4096 символов
+            for part in self.split_message(text):
+                messages.append((user_id, part))
+
+        # Уведомления и новое состояние подписок пишутся одной транзакцией, отправляет их диспетчер
+        with self.scrapper.database.write() as cursor:
+            if self.lease is not None and not self.lease.fence(cursor):
+                logger.warning("Lost scraper leadership, notifications are left to the new leader")
+                return
+            self.dispatcher.enqueue(cursor, messages)
+            cursor.executemany("""UPDATE Subs SET last_change=?, last_update=? WHERE user_id=? AND subgroup=?""",
+                               updates)
+        self.dispatcher.notify()
+        metrics.subscribers_scanned.inc(len(notifications))
+        metrics.messages_queued.inc(len(messages))
+        logger.info(f"Queued {len(messages)} messages for {len(notifications)} notifications")
+
+    def notify_keywords(self, document: tuple[str, datetime.date]):
+        text, date = document
+        hits = self.keyword_index.match(text)
+        if not hits:
+            return
+
+        keywords = list({keyword for _, keyword in hits})
+        with self.scrapper.database.read() as cursor:
+            cursor.execute(f"""SELECT user_id, keyword, last_date, last_match FROM KeywordSubs
+                               WHERE keyword IN ({",".join("?" * len(keywords))})""", keywords)
+            sent = {(user_id, keyword): (last_date, last_match) for user_id, keyword, last_date, last_match in cursor}
+
+        # Как и с классами, повторно сообщаем только если на эту дату совпадения изменились
+        digests = {}
+        updates = []
+        day = date.strftime("%Y-%m-%d")
+        for (user_id, keyword), lines in hits.items():
+            match = "\n".join(lines)
+            if (user_id, keyword) not in sent or sent[(user_id, keyword)] == (day, match):
                 continue
-            subscribers = get_subscribers(group)
-            for subscriber in subscribers:
-                if changes[1] > subscriber.last_update or subscriber.last_change != changes[0]:
-                    self.send_message(subscriber, changes[0], changes[1])
-
-    def send_message(self, subsctiption: Subscribe, message, date):
-        answer = f'Появилсь изменения для класса {subsctiption.subgroup} на {date.strftime("%d.%m.%Y")}: {message}'
-        try:
-            update_subscription(subsctiption, message, date)
-            self.bot.send_message(subsctiption.user_id, answer)
-
-        except Exception as e:
-            self.bot.send_message(subsctiption.user_id, f'Ошибка при отправке сообщения: {e}')
+            digests.setdefault(user_id, []).append(f"«{keyword}»:\n{match}")
+            updates.append((day, match, user_id, keyword))
+
+        if not updates:
+            return
+
+        messages = []
+        for user_id, parts in digests.items():
+            header = f'Упоминания в изменениях на {date.strftime("%d.%m.%Y")}:\n\n'
+            for part in self.split_message(header + "\n\n".join(parts)):
+                messages.append((user_id, part))
+
+        with self.scrapper.database.write() as cursor:
+            if self.lease is not None and not self.lease.fence(cursor):
+                logger.warning("Lost scraper leadership, keyword notifications are left to the new leader")
+                return
+            self.dispatcher.enqueue(cursor, messages)
+            cursor.executemany("""UPDATE KeywordSubs SET last_date=?, last_match=? WHERE user_id=? AND keyword=?""",
+                               updates)
+        self.dispatcher.notify()
+        metrics.messages_queued.inc(len(messages))
+        logger.info(f"Queued {len(messages)} keyword messages for {len(updates)} matches")
+
+    @staticmethod
+    def split_message(text: str, limit: int = 4096) -> list[str]:
+        # Telegram не принимает сообщения длиннее 4096 символов
+        parts = []
+        while len(text) > limit:
+            cut = text.rfind("\n", 0, limit)
+            if cut <= 0:
+                cut = limit
+            parts.append(text[:cut])
+            text = text[cut:].lstrip("\n")
+
+        parts.append(text)
+        return parts
 
     def admin_message(self, message, recipients):
         for recipient in recipients:
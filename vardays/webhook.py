@@ -0,0 +1,179 @@
+import argparse
+import hmac
+import json
+import queue
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import TeleBot, types
+
+from settings import settings, logger
+
+
+class WebhookServer:
+    def __init__(self,
+                 bot: TeleBot,
+                 host: str = "0.0.0.0",
+                 port: int = 8443,
+                 path: str = "/webhook",
+                 secret: str = None,
+                 workers: int = 4,
+                 queue_size: int = 1000,
+                 enqueue_timeout: float = 1,
+                 max_body: int = 1024 * 1024,
+                 ) -> None:
+        if bot.threaded:
+            logger.warning("Webhook bot is threaded: handlers will run in the telebot pool, unordered and unbounded")
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self.max_body = max_body
+        # Ограниченные очереди: если обработчики не успевают, отвечаем 503 и telegram повторит доставку позже.
+        # Обновления одного чата всегда попадают в одну очередь, чтобы диалоги обрабатывались по порядку
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.server = None
+
+    def authorized(self, token: str | None) -> bool:
+        # Без секрета нельзя отличить telegram от любого, кто знает адрес, поэтому такие запросы не принимаем
+        if not self.secret:
+            return False
+        return token is not None and hmac.compare_digest(token.encode(), self.secret.encode())
+
+    @staticmethod
+    def chat_id(update: types.Update) -> int:
+        for event in (update.message, update.edited_message, update.callback_query, update.my_chat_member):
+            if event is not None:
+                return event.from_user.id if event.from_user else event.chat.id
+        return update.update_id
+
+    def submit(self, payload: bytes) -> int:
+        try:
+            update = types.Update.de_json(json.loads(payload))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Webhook received malformed update: {e}")
+            return 400
+
+        try:
+            self.queues[self.chat_id(update) % self.workers].put(update, timeout=self.enqueue_timeout)
+        except queue.Full:
+            logger.warning("Webhook queue is full, rejecting update")
+            return 503
+
+        return 200
+
+    def worker(self, updates: queue.Queue) -> None:
+        # Бот должен быть создан с threaded=False, тогда обработчик отработает здесь, а не в пуле telebot
+        while True:
+            update = updates.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Failed to process update {update.update_id}: {e}")
+            finally:
+                updates.task_done()
+
+    def handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                if self.path != webhook.path:
+                    self.respond(404)
+                    return
+
+                if not webhook.authorized(self.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+                    logger.warning(f"Webhook request with wrong secret token from {self.client_address[0]}")
+                    self.respond(403)
+                    return
+
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > webhook.max_body:
+                    # Тело не читаем, поэтому соединение дальше использовать нельзя
+                    self.close_connection = True
+                    self.respond(400 if length < 0 else 413)
+                    return
+
+                self.respond(webhook.submit(self.rfile.read(length)))
+
+            def respond(self, status: int) -> None:
+                self.send_response(status)
+                if status == 503:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def register(self, url: str, max_connections: int = 40) -> None:
+        self.bot.remove_webhook()
+        self.bot.set_webhook(url=url, secret_token=self.secret, max_connections=max_connections)
+        logger.info(f"Webhook registered at {url}")
+
+    def start(self) -> ThreadingHTTPServer:
+        for index, updates in enumerate(self.queues):
+            threading.Thread(target=self.worker, args=(updates,), daemon=True, name=f"webhook-{index}").start()
+
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="webhook").start()
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+        return self.server
+
+    def serve_forever(self) -> None:
+        self.start()
+        threading.Event().wait()
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def from_settings(bot: TeleBot) -> WebhookServer:
+    if not settings["webhook_secret"]:
+        raise ValueError("webhook_secret must be set to run the bot in webhook mode")
+
+    return WebhookServer(bot,
+                         host=settings["webhook_host"] or "0.0.0.0",
+                         port=settings["webhook_port"] or 8443,
+                         path=settings["webhook_path"] or "/webhook",
+                         secret=settings["webhook_secret"],
+                         workers=settings["webhook_workers"] or 4,
+                         queue_size=settings["webhook_queue_size"] or 1000,
+                         max_body=settings["webhook_max_body"] or 1024 * 1024)
+
+
+def replay(file: str, url: str, secret: str = None) -> None:
+    # Отправляет записанные обновления (json-массив или по одному на строку), чтобы проверить режим локально
+    with open(file, encoding="utf-8") as updates_file:
+        content = updates_file.read().strip()
+    updates = json.loads(content) if content.startswith("[") else [json.loads(line) for line in content.splitlines() if line]
+
+    for update in updates:
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        if secret:
+            request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+        with urllib.request.urlopen(request) as response:
+            print(f"{update.get('update_id')}: {response.status}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Отправляет записанные обновления telegram на вебхук бота")
+    parser.add_argument("file")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{settings['webhook_port'] or 8443}"
+                                         f"{settings['webhook_path'] or '/webhook'}")
+    args = parser.parse_args()
+    replay(args.file, args.url, settings["webhook_secret"])